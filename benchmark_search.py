@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark the free text scoring engines of SongDatabase against each other.
+
+Usage: python benchmark_search.py [--songs songs.json] [--copies 10]
+
+`--copies` repeats the songbook to simulate several merged songbooks.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+
+from fiisubot import SCORERS, SongDatabase, expand_songs, tokenize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--songs", default="songs.json", help="songs file to load")
+    parser.add_argument(
+        "--copies", type=int, default=1, help="how many times to repeat the songs"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=200, help="number of queries to run"
+    )
+    parser.add_argument("--limit", type=int, default=50, help="results per query")
+    args = parser.parse_args()
+
+    with open(args.songs, encoding="utf-8") as f:
+        songs = expand_songs(json.load(f))
+
+    # Broad queries: the most common lyrics words and their prefixes
+    counts = Counter(word for song in songs for word in tokenize(song["lyrics"]))
+    common = [word for word, _ in counts.most_common(args.queries // 2)]
+    queries = common + [word[:3] for word in common]
+    queries += [f"{a} {b}" for a, b in zip(common, common[1:])][:20]
+
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".json", encoding="utf-8", delete=False
+    ) as f:
+        json.dump(songs * args.copies, f, ensure_ascii=False)
+        songs_file = f.name
+
+    try:
+        results = {}
+        for engine in SCORERS:
+            start = time.perf_counter()
+            db = SongDatabase(songs_file, engine=engine)
+            build_time = time.perf_counter() - start
+            if db.scorer.name != engine:
+                print(f"{engine}: not available, skipping")
+                continue
+
+            start = time.perf_counter()
+            results[engine] = [
+                [hit.index for hit in db.search_hits(query, args.limit)]
+                for query in queries
+            ]
+            search_time = time.perf_counter() - start
+
+            print(
+                f"{engine}: {len(db.songs)} songs, index built in "
+                f"{build_time * 1000:.0f} ms, "
+                f"{search_time / len(queries) * 1000:.3f} ms per query"
+            )
+    finally:
+        os.unlink(songs_file)
+
+    if len(results) > 1:
+        first, *rest = results.values()
+        same = all(other == first for other in rest)
+        print("Results identical:", "yes" if same else "NO")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,74 @@
+import argparse
+import hashlib
 import json
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
 import re
+import socket
+import sqlite3
+import time
+from collections import Counter, defaultdict
 from dataclasses import asdict, dataclass
 from enum import Enum
 from glob import glob
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 from TexSoup import TexSoup
 from TexSoup.data import BraceGroup, TexCmd, TexMathModeEnv, TexNamedEnv, TexNode
 from tqdm import tqdm
 
+# The bot reads what is extracted here, so the helpers both need are shared
+from fiisubot import SHARED_FIELDS, char_ngrams, escape_html, expand_songs, song_key
+
+
+@dataclass
+class Diagnostic:
+    """A problem met while extracting a song file."""
+
+    file: str
+    song: Optional[str]
+    # LaTeX command or environment that caused it, if known
+    command: Optional[str]
+    severity: str
+    message: str
+
+
+class Diagnostics:
+    """
+    Problems met while extracting, collected instead of printed as they
+    happen, and written once into the extraction report.
+    """
+
+    def __init__(self):
+        self.records: List[Diagnostic] = []
+        # File and song being extracted, for the records
+        self.file = ""
+        self.song: Optional[str] = None
+
+    def add(self, severity: str, message: str, command: Optional[str] = None) -> None:
+        self.records.append(
+            Diagnostic(self.file, self.song, command, severity, message)
+        )
+
+    def warning(self, message: str, command: Optional[str] = None) -> None:
+        self.add("warning", message, command)
+
+    def error(self, message: str, command: Optional[str] = None) -> None:
+        self.add("error", message, command)
+
+    def forget(self, file: str) -> None:
+        """Drop the records of a file that is extracted again or removed."""
+        self.records = [record for record in self.records if record.file != file]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of records of each severity."""
+        return dict(Counter(record.severity for record in self.records))
+
+
+diagnostics = Diagnostics()
+
 
 def removeprefix(a, b):
     return a.removeprefix(b)
@@ -52,7 +112,7 @@ def latex_str_to_str(latex: str) -> str:
     space_preserving_regex = re.compile(r"^(.*?)$", flags=re.DOTALL)
     match = space_preserving_regex.match(latex)
     if match is None:
-        print(f"Warning: Could not parse latex string: {repr(latex)}")
+        diagnostics.warning(f"Could not parse latex string: {latex!r}")
         return latex  # Return as-is instead of breaking
     return match.group(1)
 
@@ -322,7 +382,7 @@ def verse_args_to_str(
                     out += verse_args_to_str(line.contents)
                 else:
                     # Instead of raising an exception, log a warning and skip
-                    print(f"Warning: Unexpected TexCmd {line.name}, skipping")
+                    diagnostics.warning("Unexpected command, skipping", line.name)
                     continue
             elif isinstance(line, TexMathModeEnv):
                 out += verse_args_to_str(line.contents)
@@ -330,10 +390,14 @@ def verse_args_to_str(
                 out += verse_args_to_str(line.contents)
             else:
                 # Instead of raising an exception, log a warning and skip
-                print(f"Warning: Unexpected line type {type(line)}, skipping")
+                diagnostics.warning(
+                    f"Unexpected line type {type(line).__name__}, skipping"
+                )
                 continue
         except (ValueError, AttributeError, IndexError) as e:
-            print(f"Error processing verse content {line}: {e}")
+            diagnostics.error(
+                f"Error processing verse content: {e}", getattr(line, "name", None)
+            )
             continue
     return out
 
@@ -407,7 +471,7 @@ def handle_nverse(nverse: TexSoup) -> str:
         repeat_content = verse_args_to_str(nverse.args[1].contents)
         raw_content = verse_content + "\n" + repeat_content
     else:
-        print(f"Warning: Unexpected number of arguments for {nverse.name}")
+        diagnostics.warning("Unexpected number of arguments", nverse.name)
         return ""
 
     # Clean up whitespace specifically for verse content
@@ -491,10 +555,12 @@ def handle_verses_no_subsongs(content: List[TexNode]) -> str:
                 note_content = verse_args_to_str(c.contents)
                 out += f"NEWCHAPTER<i>{note_content}</i>NEWCHAPTER"
             else:
-                print(f"Warning: Unexpected verse type `{c.name}`, skipping")
+                diagnostics.warning("Unexpected verse type, skipping", c.name)
                 continue
         except (ValueError, AttributeError, IndexError) as e:
-            print(f"Error processing verse content {c}: {e}")
+            diagnostics.error(
+                f"Error processing verse content: {e}", getattr(c, "name", None)
+            )
             continue
 
     # Clean up the final output to ensure consistent spacing
@@ -584,7 +650,7 @@ def extract_subsongs(content: List[TexNode]) -> List[tuple]:
 
                     subsongs.append((subsong_name, subsong_melody, subsong_lyrics))
             except (ValueError, AttributeError, IndexError) as e:
-                print(f"Error processing subsong {c}: {e}")
+                diagnostics.error(f"Error processing subsong: {e}", "subsong")
                 continue
 
     _extract_from_content(content)
@@ -612,7 +678,7 @@ def extract_notes(content: List[TexNode]) -> List[str]:
                 elif c.name in ["samepage", "subsong"]:
                     _extract_notes_from_content(c.contents)
             except (ValueError, AttributeError, IndexError) as e:
-                print(f"Error processing note {c}: {e}")
+                diagnostics.error(f"Error processing note: {e}", "note")
                 continue
 
     _extract_notes_from_content(content)
@@ -628,6 +694,10 @@ class SongInfo:
     lyrics: str
     # Additional original song information
     notes: Optional[str] = None
+    # Source file name and subsong index, see `assign_id`
+    id: str = ""
+    # Hash of the other fields, see `assign_id`
+    content_hash: str = ""
 
 
 def first_or_none(x):
@@ -651,6 +721,7 @@ def parse_tex(content: Union[str, bytes]) -> List[SongInfo]:
         song_name = "Unknown Song"
         if name and hasattr(name, "contents") and name.contents:
             song_name = clean_parameter_text(verse_args_to_str(name.contents))
+        diagnostics.song = song_name
 
         # Safely extract melody with proper LaTeX processing
         song_melody = None
@@ -737,7 +808,7 @@ def parse_tex(content: Union[str, bytes]) -> List[SongInfo]:
         return songs
 
     except (ValueError, AttributeError, IndexError) as e:
-        print(f"Error parsing TeX content: {e}")
+        diagnostics.error(f"Error parsing TeX content: {e}")
         # Return a minimal song info
         return [
             SongInfo(
@@ -772,62 +843,598 @@ def song_contains_todo(song: SongInfo) -> bool:
     return False
 
 
-def main():
-    songs = []
-    failed_files = []
-
-    print("Starting song extraction from Fiisut-V/songs/*.tex")
-    tex_files = glob("Fiisut-V/songs/*.tex")
-    print(f"Found {len(tex_files)} .tex files")
+# Character n-gram sizes of the similarity vectors
+NGRAM_MIN = 3
+NGRAM_MAX = 5
+NGRAM_SIZES = range(NGRAM_MIN, NGRAM_MAX + 1)
+RELATED_COUNT = 5
+
+
+def first_verse(lyrics: str) -> str:
+    """Return the first verse of lyrics, verses being separated by blank lines."""
+    return re.split(r"\n\s*\n", lyrics.strip(), maxsplit=1)[0]
+
+
+def build_similarity_index(songs: List[Dict]) -> Dict:
+    """
+    Build TF-IDF vectors of character n-grams for the name and first verse of
+    each song, and the most similar songs for each song.
+
+    The vectors are L2-normalized so that dot products are cosine similarities.
+    """
+    texts = {
+        "names": [char_ngrams(song["name"], NGRAM_SIZES) for song in songs],
+        "verses": [
+            char_ngrams(first_verse(song["lyrics"]), NGRAM_SIZES) for song in songs
+        ],
+    }
+
+    # Document frequencies over names and verses together
+    df: Counter = Counter()
+    for counts in texts["names"] + texts["verses"]:
+        df.update(counts.keys())
+    n_docs = len(texts["names"]) + len(texts["verses"])
+    vocab = sorted(df)
+    columns = {ngram: col for col, ngram in enumerate(vocab)}
+    idf = [math.log((1 + n_docs) / (1 + df[ngram])) + 1 for ngram in vocab]
+
+    vectors: Dict[str, List[List[List[float]]]] = {}
+    for kind, all_counts in texts.items():
+        vectors[kind] = []
+        for counts in all_counts:
+            weights = {
+                columns[ngram]: (1 + math.log(count)) * idf[columns[ngram]]
+                for ngram, count in counts.items()
+            }
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            vectors[kind].append(
+                [[col, round(w / norm, 4)] for col, w in sorted(weights.items())]
+            )
 
-    for pa in tqdm(tex_files, desc="Processing songs"):
-        if not any(x in pa.lower() for x in WHITELIST):
+    # Related songs: average of name and first verse similarity
+    postings: Dict[str, Dict[int, List]] = {kind: defaultdict(list) for kind in vectors}
+    for kind in vectors:
+        for idx, vector in enumerate(vectors[kind]):
+            for col, weight in vector:
+                postings[kind][col].append((idx, weight))
+    related = []
+    for idx in range(len(songs)):
+        scores: Counter = Counter()
+        for kind in vectors:
+            for col, weight in vectors[kind][idx]:
+                for other, other_weight in postings[kind][col]:
+                    scores[other] += weight * other_weight / 2
+        del scores[idx]
+        related.append([other for other, _ in scores.most_common(RELATED_COUNT)])
+
+    return {
+        "ngram_min": NGRAM_MIN,
+        "ngram_max": NGRAM_MAX,
+        "count": len(songs),
+        # Keys of the songs in order, so that the bot can tell whether the
+        # file is for the songs it loaded
+        "ids": [song_key(song) for song in songs],
+        "vocab": vocab,
+        "idf": [round(x, 4) for x in idf],
+        "names": vectors["names"],
+        "verses": vectors["verses"],
+        "related": related,
+    }
+
+
+def write_sqlite_database(
+    songs: List[Dict], path: str, remove_diacritics: int = 0
+) -> None:
+    """
+    Write the songs to an SQLite file with an FTS5 index of their names,
+    metadata and tag-free lyrics, for the bot's `sqlite` backend.
+
+    `remove_diacritics` is the option of the unicode61 tokenizer: 0 keeps
+    å, ä and ö apart from a and o, 1 and 2 fold them together.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.execute(
+            "CREATE TABLE songs (id INTEGER PRIMARY KEY, song_id TEXT NOT NULL, "
+            "name TEXT NOT NULL, name_key TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        connection.execute("CREATE INDEX songs_song_id ON songs (song_id)")
+        connection.execute("CREATE INDEX songs_name ON songs (name)")
+        connection.execute("CREATE INDEX songs_name_key ON songs (name_key)")
+        connection.execute(
+            "CREATE VIRTUAL TABLE songs_fts USING fts5(name, melody, composer, "
+            "arranger, lyrics, tokenize = "
+            f"'unicode61 remove_diacritics {remove_diacritics}')"
+        )
+        for idx, song in enumerate(songs, 1):
+            connection.execute(
+                "INSERT INTO songs VALUES (?, ?, ?, ?, ?)",
+                (
+                    idx,
+                    song_key(song),
+                    song["name"],
+                    " ".join(song["name"].lower().split()),
+                    json.dumps(song, ensure_ascii=False),
+                ),
+            )
+            connection.execute(
+                "INSERT INTO songs_fts (rowid, name, melody, composer, arranger, "
+                "lyrics) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    idx,
+                    song["name"],
+                    song["melody"] or "",
+                    song["composer"] or "",
+                    song["arranger"] or "",
+                    escape_html(song["lyrics"]),
+                ),
+            )
+        connection.execute("INSERT INTO songs_fts (songs_fts) VALUES ('optimize')")
+    connection.close()
+
+    # Replace the old file only once the new one is complete
+    os.replace(tmp_path, path)
+
+
+def assign_id(song: SongInfo, source: str, subsong: int) -> None:
+    """
+    Give a song an id from its source file and its index among the file's
+    songs, which stays the same between extractions, and a hash of its
+    content, which changes whenever the song does.
+    """
+    song.id = f"{os.path.splitext(os.path.basename(source))[0]}#{subsong}"
+    content = {
+        key: value
+        for key, value in asdict(song).items()
+        if key not in ("id", "content_hash")
+    }
+    song.content_hash = hashlib.sha256(
+        json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def song_changed(old: Dict, new: Dict) -> bool:
+    """Whether a song changed, by its content hash if both versions have one."""
+    if old.get("content_hash") and new.get("content_hash"):
+        return old["content_hash"] != new["content_hash"]
+    return old != new
+
+
+def change_set(old_songs: List[Dict], new_songs: List[Dict]) -> Dict[str, List[str]]:
+    """Keys of the songs added, changed and removed between two extractions."""
+    old = {song_key(song): song for song in old_songs}
+    new = {song_key(song): song for song in new_songs}
+    return {
+        "added": [key for key in new if key not in old],
+        "changed": [
+            key for key in new if key in old and song_changed(old[key], new[key])
+        ],
+        "removed": [key for key in old if key not in new],
+    }
+
+
+def normalize_songs(songs: List[Dict]) -> Dict:
+    """
+    Store the metadata shared by the songs of each source file with several
+    songs once, in a parent record per file, and each distinct note once, in
+    a notes table. Songs refer to their parent by index and keep only the
+    shared fields whose value differs from the parent's. Reversed by
+    `expand_songs`.
+    """
+    notes: List[str] = []
+    note_ids: Dict[str, int] = {}
+    parents: List[Dict] = []
+    parent_ids: Dict[str, int] = {}
+    records = []
+    # Songs of one file have ids "<file>#<subsong>", the first is the parent
+    sources = [song_key(song).partition("#")[0] for song in songs]
+    song_counts = Counter(sources)
+    for song, source in zip(songs, sources):
+        if song_counts[source] == 1:
+            records.append(song)
             continue
+        if source not in parent_ids:
+            parent_ids[source] = len(parents)
+            parents.append({field: song.get(field) for field in SHARED_FIELDS})
+        parent = parents[parent_ids[source]]
+        record = {"parent": parent_ids[source]}
+        record.update(
+            (key, value)
+            for key, value in song.items()
+            if key not in SHARED_FIELDS or value != parent[key]
+        )
+        records.append(record)
+
+    for parent in parents:
+        if parent["notes"] is not None:
+            if parent["notes"] not in note_ids:
+                note_ids[parent["notes"]] = len(notes)
+                notes.append(parent["notes"])
+            parent["notes"] = note_ids[parent["notes"]]
+    return {"notes": notes, "parents": parents, "songs": records}
+
+
+def read_previous(output: str) -> Tuple[List[Dict], Optional[str]]:
+    """The songs and version of the previous extraction to a directory."""
+    try:
+        with open(os.path.join(output, "songs.json"), encoding="utf-8") as f:
+            songs = expand_songs(json.load(f))
+        with open(os.path.join(output, "collection.json"), encoding="utf-8") as f:
+            version = json.load(f)["version"]
+    except (OSError, ValueError, KeyError):
+        return [], None
+    return songs, version
+
+
+def build_report(
+    song_count: int,
+    failed_files: List[str],
+    timings: Dict[str, float],
+    song_counts: Dict[str, int],
+    slowest: int,
+) -> Dict:
+    """Report of an extraction: its problems and how long each file took."""
+    problems = Counter(record.file for record in diagnostics.records)
+    return {
+        "files": len(timings),
+        "songs": song_count,
+        "failed_files": failed_files,
+        "parse_seconds": sum(timings.values()),
+        "severities": diagnostics.counts(),
+        "slowest_files": [
+            {
+                "file": path,
+                "seconds": seconds,
+                "songs": song_counts.get(path, 0),
+                "diagnostics": problems[path],
+            }
+            for path, seconds in sorted(
+                timings.items(), key=lambda item: item[1], reverse=True
+            )[:slowest]
+        ],
+        "diagnostics": [asdict(record) for record in diagnostics.records],
+        "file_seconds": timings,
+    }
 
-        try:
-            # Try different encodings
-            tex = None
-            for encoding in ["utf-8", "latin-1", "cp1252"]:
-                try:
-                    with open(pa, encoding=encoding) as f:
-                        tex = f.read()
-                    break
-                except UnicodeDecodeError:
-                    continue
 
-            if tex is None:
-                print(f"Could not decode file {pa} with any encoding")
-                failed_files.append(pa)
-                continue
-
-            parsed_songs = parse_tex(tex)
+def main():
+    parser = argparse.ArgumentParser(description="Extract songs from Fiisut-V")
+    parser.add_argument(
+        "--collection", default="fiisut", help="name of the songbook collection"
+    )
+    parser.add_argument(
+        "--source",
+        default="Fiisut-V/songs/*.tex",
+        help="glob of the collection's song files",
+    )
+    parser.add_argument(
+        "--output", default=".", help="directory to write the collection to"
+    )
+    parser.add_argument(
+        "--remove-diacritics",
+        type=int,
+        choices=(0, 1, 2),
+        default=0,
+        help="unicode61 tokenizer option of the SQLite full text index",
+    )
+    parser.add_argument(
+        "--report",
+        help="where to write the JSON report of problems and timings "
+        "(default: extract_report.json in the output directory)",
+    )
+    parser.add_argument(
+        "--slowest", type=int, default=10, help="slowest files to list in the report"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, extracting the files that change",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="seconds between checks for changed files in watch mode",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10.0,
+        help="seconds without changes before watch mode also updates the "
+        "song similarities, which take long to compute",
+    )
+    parser.add_argument(
+        "--notify",
+        help="Unix socket of a running bot (its RELOAD_SOCKET) to tell about "
+        "new versions",
+    )
+    args = parser.parse_args()
 
-            # Process each song (main song and subsongs)
-            for song in parsed_songs:
-                if song.name != "Parse Error":
-                    # Filter out songs that contain TODO in any field
-                    if not song_contains_todo(song):
-                        songs.append(asdict(song))
-                else:
-                    failed_files.append(pa)
-                    break  # If any song failed, mark the whole file as failed
+    failed_files = []
+    # Songs extracted from each file, in the order the files were found
+    file_songs: Dict[str, List[Dict]] = {}
+    # Seconds spent reading and parsing each file, and its number of songs
+    timings: Dict[str, float] = {}
+    song_counts: Dict[str, int] = {}
+
+    print(f"Starting song extraction from {args.source}")
+    tex_files = source_files(args.source)
+    print(f"Found {len(tex_files)} .tex files")
 
-        except (ValueError, AttributeError, IndexError, UnicodeDecodeError) as e:
-            print(f"Error processing file {pa}: {e}")
+    for pa in tqdm(tex_files, desc="Processing songs"):
+        started = time.perf_counter()
+        file_songs[pa], parsed, failed = extract_file(pa)
+        timings[pa] = time.perf_counter() - started
+        if parsed is not None:
+            song_counts[pa] = parsed
+        if failed:
             failed_files.append(pa)
-            continue
 
+    songs = [song for songs in file_songs.values() for song in songs]
     print(f"\nSuccessfully processed {len(songs)} songs")
     if failed_files:
         print(f"Failed to process {len(failed_files)} files:")
         for f in failed_files:
             print(f"  - {f}")
 
-    # Write with proper UTF-8 encoding
-    with open("songs.json", "w", encoding="utf-8") as f:
-        json.dump(songs, f, indent=2, ensure_ascii=False)
+    os.makedirs(args.output, exist_ok=True)
+    report = write_report(args, len(songs), failed_files, timings, song_counts)
+    print(f"Slowest files of {report['parse_seconds']:.2f} s of parsing:")
+    for entry in report["slowest_files"]:
+        print(f"  {entry['seconds']:7.3f} s  {entry['file']}")
+
+    write_collection(args, songs, build_similarity_index(songs))
+    if args.notify:
+        notify_bot(args.notify)
+    if args.watch:
+        watch(args, file_songs, failed_files, timings, song_counts)
+
+
+def write_report(
+    args: argparse.Namespace,
+    song_count: int,
+    failed_files: List[str],
+    timings: Dict[str, float],
+    song_counts: Dict[str, int],
+) -> Dict:
+    """Write the extraction report and print how many problems it has."""
+    report = build_report(song_count, failed_files, timings, song_counts, args.slowest)
+    report_file = args.report or os.path.join(args.output, "extract_report.json")
+    write_json(report_file, report)
+
+    counts = report["severities"]
+    print(
+        f"{counts.get('error', 0)} errors and {counts.get('warning', 0)} warnings, "
+        f"see {report_file}"
+    )
+    return report
+
+
+def source_files(pattern: str) -> List[str]:
+    """The song files matching a glob that are to be extracted."""
+    return [pa for pa in glob(pattern) if any(x in pa.lower() for x in WHITELIST)]
+
+
+def extract_file(pa: str) -> Tuple[List[Dict], Optional[int], bool]:
+    """
+    Extract the songs of one file. Returns the songs, the number of songs
+    parsed or None if the file couldn't be read, and whether it failed.
+    """
+    diagnostics.file = pa
+    diagnostics.song = None
+    songs: List[Dict] = []
+    try:
+        # Try different encodings
+        tex = None
+        for encoding in ["utf-8", "latin-1", "cp1252"]:
+            try:
+                with open(pa, encoding=encoding) as f:
+                    tex = f.read()
+                break
+            except UnicodeDecodeError:
+                continue
+
+        if tex is None:
+            diagnostics.error("Could not decode file with any encoding")
+            return songs, None, True
 
-    print(f"Wrote {len(songs)} songs to songs.json")
+        parsed_songs = parse_tex(tex)
+
+        # Process each song (main song and subsongs)
+        for subsong, song in enumerate(parsed_songs):
+            if song.name != "Parse Error":
+                # Filter out songs that contain TODO in any field
+                if not song_contains_todo(song):
+                    assign_id(song, pa, subsong)
+                    songs.append(asdict(song))
+            else:
+                # If any song failed, mark the whole file as failed
+                return songs, len(parsed_songs), True
+        return songs, len(parsed_songs), False
+
+    except (ValueError, AttributeError, IndexError, UnicodeDecodeError, OSError) as e:
+        diagnostics.error(f"Error processing file: {e}")
+        return songs, None, True
+
+
+def write_json(path: str, data, indent: Optional[int] = 2) -> None:
+    """Write a JSON file in one go, so that readers never see half of it."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def write_collection(
+    args: argparse.Namespace, songs: List[Dict], similarity: Optional[Dict]
+) -> None:
+    """
+    Write the songs and everything derived from them to the output
+    directory, collection.json last since the bot watches its version.
+    Without `similarity` the song similarities are left as they were.
+    """
+    songs_file = os.path.join(args.output, "songs.json")
+    similarity_file = os.path.join(args.output, "similarity.json")
+    old_songs, old_version = read_previous(args.output)
+
+    # Write with proper UTF-8 encoding, the shared metadata of subsongs once
+    write_json(songs_file, normalize_songs(songs))
+
+    print(f"Wrote {len(songs)} songs to {songs_file}")
+
+    if similarity is not None:
+        write_json(similarity_file, similarity, indent=None)
+
+        print("Wrote song similarity vectors to similarity.json")
+
+    write_sqlite_database(
+        songs, os.path.join(args.output, "songs.sqlite3"), args.remove_diacritics
+    )
+
+    print(f"Wrote {len(songs)} songs to songs.sqlite3")
+
+    # The version changes whenever the songs or their similarities do, so
+    # the bot reloads only the collections that changed
+    digest = hashlib.sha256()
+    for path in (songs_file, similarity_file):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    version = digest.hexdigest()[:12]
+
+    # What changed since the previous extraction, so that the bot can update
+    # just those songs
+    changes = change_set(old_songs, songs)
+    write_json(
+        os.path.join(args.output, "changes.json"),
+        {"from_version": old_version, "to_version": version, **changes},
+    )
+
+    print(
+        f"Changes since version {old_version}: {len(changes['added'])} added, "
+        f"{len(changes['changed'])} changed, {len(changes['removed'])} removed"
+    )
+    write_json(
+        os.path.join(args.output, "collection.json"),
+        {"name": args.collection, "version": version, "songs": len(songs)},
+    )
+
+    print(f"Collection {args.collection} is at version {version}")
+
+
+def notify_bot(path: str) -> None:
+    """Tell a running bot to reload the collections that changed."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(30)
+            connection.connect(path)
+            connection.sendall(b"reload\n")
+            reply = connection.makefile(encoding="utf-8").readline().strip()
+        print(f"Bot at {path}: {reply}")
+    except OSError as e:
+        print(f"Could not notify the bot at {path}: {e}")
+
+
+def file_mtimes(pattern: str) -> Dict[str, int]:
+    """Modification times of the song files, by path."""
+    mtimes = {}
+    for pa in source_files(pattern):
+        try:
+            mtimes[pa] = os.stat(pa).st_mtime_ns
+        except OSError:
+            # Removed since globbing
+            continue
+    return mtimes
+
+
+def watch(
+    args: argparse.Namespace,
+    file_songs: Dict[str, List[Dict]],
+    failed_files: List[str],
+    timings: Dict[str, float],
+    song_counts: Dict[str, int],
+) -> None:
+    """
+    Poll the song files, extract the files that changed, were added or were
+    removed and write the collection again, telling the bot with --notify.
+
+    The song similarities take long to compute for all songs, so they're
+    computed in another process once there have been no changes for
+    --settle seconds, and written if there are still none by then.
+    """
+    mtimes = file_mtimes(args.source)
+    # When the similarities were last left out, or None if they're up to date
+    similarity_stale_since: Optional[float] = None
+    # Similarities being computed for the songs as they are now
+    similarity: Optional[multiprocessing.pool.AsyncResult] = None
+    pool = multiprocessing.Pool(1)
+    print(f"Watching {args.source} for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = file_mtimes(args.source)
+            changed = [pa for pa, mtime in current.items() if mtimes.get(pa) != mtime]
+            removed = [pa for pa in file_songs if pa not in current]
+            if not changed and not removed:
+                songs = [song for songs in file_songs.values() for song in songs]
+                if similarity is not None and similarity.ready():
+                    write_collection(args, songs, similarity.get())
+                    if args.notify:
+                        notify_bot(args.notify)
+                    similarity = similarity_stale_since = None
+                elif (
+                    similarity is None
+                    and similarity_stale_since is not None
+                    and time.monotonic() - similarity_stale_since >= args.settle
+                ):
+                    similarity = pool.apply_async(build_similarity_index, (songs,))
+                continue
+
+            started = time.perf_counter()
+            first_record = len(diagnostics.records)
+            for pa in changed + removed:
+                diagnostics.forget(pa)
+                timings.pop(pa, None)
+                song_counts.pop(pa, None)
+                if pa in failed_files:
+                    failed_files.remove(pa)
+            for pa in changed:
+                file_started = time.perf_counter()
+                file_songs[pa], parsed, failed = extract_file(pa)
+                timings[pa] = time.perf_counter() - file_started
+                if parsed is not None:
+                    song_counts[pa] = parsed
+                if failed:
+                    failed_files.append(pa)
+            for pa in removed:
+                del file_songs[pa]
+            for record in diagnostics.records[first_record:]:
+                print(f"{record.severity}: {record.file}: {record.message}")
+            mtimes = current
+
+            songs = [song for songs in file_songs.values() for song in songs]
+            write_report(args, len(songs), failed_files, timings, song_counts)
+            write_collection(args, songs, None)
+            if args.notify:
+                notify_bot(args.notify)
+            # Similarities being computed are for the songs before the change
+            if similarity is not None and not similarity.ready():
+                pool.terminate()
+                pool = multiprocessing.Pool(1)
+            similarity = None
+            similarity_stale_since = time.monotonic()
+            print(
+                f"Extracted {len(changed)} changed and dropped {len(removed)} "
+                f"removed files in {time.perf_counter() - started:.2f} s"
+            )
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        pool.terminate()
 
 
 if __name__ == "__main__":
@@ -6,22 +6,62 @@ A Telegram command bot for searching and displaying Finnish student songs from F
 Use /fiisu <search_term> to search for songs.
 """
 
+from __future__ import annotations
+
+import asyncio
+import gc
+import hashlib
+import heapq
+import hmac
+import html
 import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import random
 import re
-from typing import Any, Dict, List
-
-from telegram import Update
-from telegram.constants import ParseMode
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
+import secrets
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import timedelta
+from functools import lru_cache
+from queue import Full, Queue
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
 )
 
+# python-telegram-bot is imported where it's used, so that tools importing
+# this module (and startup before the songs are loaded) don't wait for it
+if TYPE_CHECKING:
+    from telegram import (
+        InlineKeyboardMarkup,
+        InlineQueryResultArticle,
+        Message,
+        Update,
+    )
+    from telegram.ext import Application, ContextTypes
 
 # Configure logging
 logging.basicConfig(
@@ -30,19 +70,817 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-class SongDatabase:
+def normalize_query(query: str) -> str:
+    """Normalize a query so that trivially different queries compare equal."""
+    return " ".join(query.lower().split())
+
+
+def escape_html(text: str) -> str:
+    """Remove HTML tags from text."""
+    # Remove HTML tags
+    clean_text = re.sub(r"<[^>]+>", "", text)
+    return clean_text
+
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase words, ignoring HTML tags."""
+    return WORD.findall(escape_html(text).lower())
+
+
+# Song fields that can be searched separately, and the prefixes used for them
+SEARCH_FIELDS = ("name", "melody", "composer", "arranger", "lyrics")
+FIELD_ALIASES = {
+    "nimi": "name",
+    "sävel": "melody",
+    "melodia": "melody",
+    "säv": "composer",
+    "säveltäjä": "composer",
+    "sov": "arranger",
+    "sovittaja": "arranger",
+    "sanat": "lyrics",
+}
+
+# A field prefix, a quoted phrase or a plain word
+QUERY_PART = re.compile(
+    r"(?<!\S)("
+    + "|".join(sorted(FIELD_ALIASES, key=len, reverse=True))
+    + r'):\s*|"([^"]*)"?(?:~(\d+))?|(\S+)',
+    flags=re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True)
+class CompiledQuery:
+    """A parsed search query."""
+
+    # Free text searched from song names and lyrics
+    text: str
+    # Quoted phrases that must all appear in the name or lyrics
+    phrases: Tuple[str, ...]
+    # (field, value) pairs that must all match
+    fields: Tuple[Tuple[str, str], ...]
+    # (words, distance) pairs: the words must appear in the lyrics within
+    # `distance` words of each other, in any order
+    near: Tuple[Tuple[str, int], ...] = ()
+
+    def is_empty(self) -> bool:
+        return not (self.text or self.phrases or self.fields or self.near)
+
+
+@lru_cache(maxsize=1024)
+def compile_query(query: str) -> CompiledQuery:
+    """
+    Parse a query such as `kippis sävel: helan går "ja juodaan"`.
+
+    A field prefix (`nimi:`, `sävel:`, `säv:`, `sov:`, `sanat:`) takes the words
+    after it up to the next field prefix, or a single quoted phrase. Other
+    quoted phrases must appear as such, `"words"~N` means the words within N
+    words of each other in the lyrics, and the remaining words are searched as
+    one piece of text like before.
+    """
+    words: List[str] = []
+    phrases: List[str] = []
+    near: List[Tuple[str, int]] = []
+    fields: List[Tuple[str, str]] = []
+    field: Optional[str] = None
+    field_words: List[str] = []
+
+    def end_field() -> None:
+        nonlocal field
+        if field and field_words:
+            fields.append((field, normalize_query(" ".join(field_words))))
+        field_words.clear()
+        field = None
+
+    for match in QUERY_PART.finditer(query):
+        prefix, phrase, distance, word = match.groups()
+        if prefix:
+            end_field()
+            field = FIELD_ALIASES[prefix.lower()]
+        elif phrase is not None:
+            if field and not field_words:
+                # A quoted value ends the field
+                field_words.append(phrase)
+                end_field()
+            else:
+                end_field()
+                if not normalize_query(phrase):
+                    continue
+                if distance is not None:
+                    near.append((normalize_query(phrase), int(distance)))
+                else:
+                    phrases.append(normalize_query(phrase))
+        elif field:
+            field_words.append(word)
+        else:
+            words.append(word)
+    end_field()
+
+    return CompiledQuery(
+        text=normalize_query(" ".join(words)),
+        phrases=tuple(phrases),
+        fields=tuple(fields),
+        near=tuple(near),
+    )
+
+
+@lru_cache(maxsize=1024)
+def query_terms(query: str) -> FrozenSet[str]:
+    """Words of a query that are looked up from lyrics, for highlighting."""
+    compiled = compile_query(query)
+    parts = [compiled.text, *compiled.phrases]
+    parts += [phrase for phrase, _ in compiled.near]
+    parts += [value for field, value in compiled.fields if field == "lyrics"]
+    return frozenset(word for part in parts for word in tokenize(part))
+
+
+VERSE_BREAK = re.compile(r"\n\s*\n")
+
+
+@dataclass
+class LyricsLayout:
+    """Where the words and lines of one song's lyrics are."""
+
+    # Lyrics without HTML tags, which all offsets refer to
+    plain: str
+    # Character offsets of each word, indexed by word position
+    word_starts: "array[int]"
+    word_ends: "array[int]"
+    # Position of the first word, character offset and (verse, line) numbers
+    # of each line that has words
+    line_words: List[int]
+    line_offsets: List[int]
+    line_numbers: List[Tuple[int, int]]
+
+    @classmethod
+    def build(cls, lyrics: str) -> "LyricsLayout":
+        plain = escape_html(lyrics)
+        layout = cls(plain, array("I"), array("I"), [], [], [])
+        offset = 0
+        verse_no = line_no = 0
+        in_break = True
+        for line in plain.split("\n"):
+            if not line.strip():
+                # Blank lines separate verses
+                in_break = True
+            else:
+                if in_break:
+                    verse_no, line_no, in_break = verse_no + 1, 0, False
+                line_no += 1
+                first = len(layout.word_starts)
+                for match in WORD.finditer(line):
+                    layout.word_starts.append(offset + match.start())
+                    layout.word_ends.append(offset + match.end())
+                if len(layout.word_starts) > first:
+                    layout.line_words.append(first)
+                    layout.line_offsets.append(offset)
+                    layout.line_numbers.append((verse_no, line_no))
+            offset += len(line) + 1
+        return layout
+
+    def words(self) -> List[str]:
+        """Lowercased words in order of position."""
+        plain = self.plain
+        return [
+            plain[start:end].lower()
+            for start, end in zip(self.word_starts, self.word_ends)
+        ]
+
+    def line_of_word(self, position: int) -> int:
+        return bisect_right(self.line_words, position) - 1
+
+    def line_of_offset(self, offset: int) -> int:
+        return max(bisect_right(self.line_offsets, offset) - 1, 0)
+
+
+@dataclass
+class SearchHit:
+    """A song matching a search, with where in the lyrics it matched."""
+
+    # Without the lyrics from backends that keep them compressed, see `hit_song`
+    song: Dict[str, Any]
+    # Higher is better, comparable between shards using the same backend
+    score: float
+    # Index of the song in the database
+    index: int = -1
+    # 1-based verse and line within the verse of the first lyrics match
+    verse: Optional[int] = None
+    line: Optional[int] = None
+    # Character span of the first lyrics match in the tag-free lyrics
+    start: Optional[int] = None
+    end: Optional[int] = None
+    # HTML snippet of the match, from backends that make their own
+    preview: Optional[str] = None
+    # Whether the query was the whole name of the song
+    exact: bool = False
+
+
+# Scores of a name and a lyrics match of the free text
+NAME_SCORE = 10
+LYRICS_SCORE = 1
+
+# Weights of a prefix completing the start of a name, a later name word and
+# a lyrics word
+COMPLETE_NAME_START = 2 * NAME_SCORE
+COMPLETE_NAME_WORD = NAME_SCORE
+COMPLETE_LYRICS_WORD = LYRICS_SCORE
+# Completions kept per prefix, the longest completed prefix and how many of
+# the lyrics words found in the most songs can be completed
+COMPLETIONS_PER_PREFIX = 10
+MAX_COMPLETION_PREFIX = 24
+COMPLETION_LYRICS_WORDS = 2000
+
+# Least cosine similarity for suggesting a song when a search finds nothing
+SUGGESTION_MIN_SCORE = float(os.getenv("SUGGESTION_MIN_SCORE", "0.2"))
+
+# Turns the approximate score of a song into its exact score (0 = no match)
+Verifier = Callable[[int], int]
+
+
+class PythonScorer:
+    """
+    Scores free text over all songs using the name and lyrics word indexes.
+
+    Each query word is expanded to the indexed words that contain it, so a
+    single-word query scores exactly like a substring search. For multi-word
+    queries the scores are an upper bound that `verify` makes exact.
+    """
+
+    name = "python"
+
+    def __init__(self, db: "SongDatabase"):
+        self.db = db
+        self.containing = lru_cache(maxsize=4096)(self._containing)
+
+    def _containing(self, field: str, part: str) -> Tuple[str, ...]:
+        """Indexed words of a field that contain `part`."""
+        return tuple(word for word in self.db.field_vocab[field] if part in word)
+
+    def update(self, indexes: Iterable[int]) -> None:
+        """Take changes to the songs at the given indexes into account."""
+        # Changes add words to the vocabularies that cached lookups miss
+        self.containing.cache_clear()
+
+    def _songs_containing(self, field: str, words: List[str]) -> Set[int]:
+        """Songs where every query word is part of some word of the field."""
+        index = self.db.field_index[field]
+        songs: Optional[Set[int]] = None
+        for part in words:
+            matches: Set[int] = set()
+            for word in self.containing(field, part):
+                matches |= index[word]
+            songs = matches if songs is None else songs & matches
+            if not songs:
+                break
+        return songs or set()
+
+    def rank(
+        self,
+        words: List[str],
+        candidates: Optional[Set[int]],
+        limit: int,
+        verify: Optional[Verifier] = None,
+    ) -> List[Tuple[int, int]]:
+        """Top (score, song index) pairs, best first and most viewed on ties."""
+        in_name = self._songs_containing("name", words)
+        in_lyrics = self._songs_containing("lyrics", words)
+        songs = in_name | in_lyrics
+        if candidates is not None:
+            songs &= candidates
+
+        scored = []
+        for idx in songs:
+            score = NAME_SCORE * (idx in in_name) + LYRICS_SCORE * (idx in in_lyrics)
+            if verify is not None:
+                score = verify(idx)
+            if score > 0:
+                scored.append((score, idx))
+
+        order = self.db.tie_order
+        return heapq.nsmallest(limit, scored, key=lambda x: (-x[0], order[x[1]]))
+
+
+class NumpyScorer(PythonScorer):
+    """
+    Same scoring as `PythonScorer`, but over sparse song-word matrices.
+
+    All query words are matched in one sparse product per field, and the top
+    results are picked with `argpartition` instead of sorting every match.
+    """
+
+    name = "numpy"
+
+    def __init__(self, db: "SongDatabase"):
+        # Imported here so that numpy and scipy stay optional
+        import numpy  # pylint: disable=import-outside-toplevel
+        from scipy import sparse  # pylint: disable=import-outside-toplevel
+
+        super().__init__(db)
+        self.np = numpy
+        self.sparse = sparse
+        self.matrices = {}
+        self.columns = {}
+        for field in ("name", "lyrics"):
+            vocab = db.field_vocab[field]
+            self.columns[field] = {word: col for col, word in enumerate(vocab)}
+            rows, cols = [], []
+            for col, word in enumerate(vocab):
+                for idx in db.field_index[field][word]:
+                    rows.append(idx)
+                    cols.append(col)
+            self.matrices[field] = sparse.csr_matrix(
+                (numpy.ones(len(rows), dtype=numpy.int32), (rows, cols)),
+                shape=(len(db.songs), len(vocab)),
+            )
+
+    def update(self, indexes: Iterable[int]) -> None:
+        """
+        Replace the matrix rows of the songs at the given indexes. New words
+        get new columns, and the columns of words left without songs stay
+        empty, so the other rows don't need to be rebuilt.
+        """
+        super().update(indexes)
+        np = self.np
+        indexes = sorted(set(indexes))
+        for field, matrix in self.matrices.items():
+            columns = self.columns[field]
+            rows, cols = [], []
+            for idx in indexes:
+                for word in set(self.db.field_texts[field][idx].split()):
+                    if word not in columns:
+                        columns[word] = len(columns)
+                    rows.append(idx)
+                    cols.append(columns[word])
+            shape = (len(self.db.songs), len(columns))
+            matrix.resize(shape)
+            keep = np.ones(shape[0], dtype=np.int32)
+            keep[indexes] = 0
+            changed = self.sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=shape
+            )
+            self.matrices[field] = (
+                self.sparse.diags(keep, format="csr", dtype=np.int32) @ matrix + changed
+            ).tocsr()
+
+    def _all_words(self, field: str, words: List[str]):
+        """Boolean vector of songs where every query word is part of a word."""
+        np = self.np
+        columns = self.columns[field]
+        rows, cols = [], []
+        for i, part in enumerate(words):
+            for word in self.containing(field, part):
+                rows.append(columns[word])
+                cols.append(i)
+        query = self.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(len(columns), len(words)),
+        )
+        counts = (self.matrices[field] @ query).toarray()
+        return (counts > 0).all(axis=1)
+
+    def rank(
+        self,
+        words: List[str],
+        candidates: Optional[Set[int]],
+        limit: int,
+        verify: Optional[Verifier] = None,
+    ) -> List[Tuple[int, int]]:
+        np = self.np
+        scores = NAME_SCORE * self._all_words("name", words).astype(np.int64)
+        scores += LYRICS_SCORE * self._all_words("lyrics", words)
+        if candidates is not None:
+            allowed = np.zeros(len(scores), dtype=bool)
+            allowed[list(candidates)] = True
+            scores[~allowed] = 0
+
+        matches = np.flatnonzero(scores)
+        if verify is not None:
+            scores[matches] = [verify(int(idx)) for idx in matches]
+            matches = matches[scores[matches] > 0]
+
+        tie_order = np.frombuffer(self.db.tie_order, dtype=np.uint32).astype(np.int64)
+        if len(matches) > limit:
+            # Unique keys so that ties are broken like `PythonScorer` does
+            keys = scores[matches] * len(scores) - tie_order[matches]
+            matches = matches[np.argpartition(-keys, limit - 1)[:limit]]
+        order = np.lexsort((tie_order[matches], -scores[matches]))
+        return [(int(scores[idx]), int(idx)) for idx in matches[order]]
+
+
+SCORERS = {"python": PythonScorer, "numpy": NumpyScorer}
+
+
+def char_ngrams(text: str, sizes: range) -> Dict[str, int]:
+    """Count the character n-grams of text."""
+    text = " " + " ".join(escape_html(text).lower().split()) + " "
+    counts: Dict[str, int] = defaultdict(int)
+    for n in sizes:
+        for i in range(len(text) - n + 1):
+            counts[text[i : i + n]] += 1
+    return counts
+
+
+class SimilarityIndex:
+    """
+    Character n-gram TF-IDF vectors of song names and first verses, and the
+    related songs of each song, precomputed by extract_songs.py.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.sizes = range(data["ngram_min"], data["ngram_max"] + 1)
+        self.columns = {ngram: col for col, ngram in enumerate(data["vocab"])}
+        self.idf: List[float] = data["idf"]
+        self.related: List[List[int]] = data["related"]
+        # n-gram column -> (song index, weight) for names and first verses
+        self.postings: List[Dict[int, List[Tuple[int, float]]]] = []
+        for kind in ("names", "verses"):
+            postings: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+            for idx, vector in enumerate(data[kind]):
+                for col, weight in vector:
+                    postings[col].append((idx, weight))
+            self.postings.append(postings)
+
+    @classmethod
+    def load(cls, path: str, keys: List[str]) -> Optional["SimilarityIndex"]:
+        """
+        Load the vectors of the songs with the given keys, in order, or return
+        None if they're missing or for other songs.
+        """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.warning("Similarity file %s not found, suggestions disabled", path)
+            return None
+        except json.JSONDecodeError as e:
+            logger.error("Error parsing similarity file: %s", e)
+            return None
+
+        # Files written before they listed their songs have only the count
+        if data.get("ids", keys) != keys or data.get("count") != len(keys):
+            logger.warning(
+                "Similarity file %s is for other songs; suggestions disabled", path
+            )
+            return None
+        return cls(data)
+
+    def vectorize(self, text: str) -> Dict[int, float]:
+        """TF-IDF vector of text, leaving out n-grams no song has."""
+        weights = {
+            self.columns[ngram]: (1 + math.log(count)) * self.idf[self.columns[ngram]]
+            for ngram, count in char_ngrams(text, self.sizes).items()
+            if ngram in self.columns
+        }
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return {col: w / norm for col, w in weights.items()}
+
+    def similar(
+        self, text: str, limit: int, min_score: float
+    ) -> List[Tuple[float, int]]:
+        """
+        Songs whose name or first verse is most similar to text, as
+        (cosine similarity, song index) pairs, best first.
+        """
+        scores: Dict[int, float] = {}
+        for postings in self.postings:
+            kind_scores: Dict[int, float] = defaultdict(float)
+            for col, weight in self.vectorize(text).items():
+                for idx, song_weight in postings.get(col, ()):
+                    kind_scores[idx] += weight * song_weight
+            for idx, score in kind_scores.items():
+                scores[idx] = max(score, scores.get(idx, 0.0))
+
+        best = heapq.nsmallest(
+            limit, scores.items(), key=lambda item: (-item[1], item[0])
+        )
+        return [(score, idx) for idx, score in best if score >= min_score]
+
+
+def read_collection(directory: str) -> Dict[str, Any]:
+    """The collection.json written by extract_songs.py, or {} if missing."""
+    try:
+        with open(os.path.join(directory, "collection.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def collection_version(directory: str) -> str:
+    """Version of the collection extracted to a directory."""
+    version = read_collection(directory).get("version")
+    if version is not None:
+        return str(version)
+    # Collections extracted before versions changed with their files
+    try:
+        return str(os.stat(os.path.join(directory, "songs.json")).st_mtime_ns)
+    except OSError:
+        return ""
+
+
+# Metadata that the songs of one source file share, stored once in songs.json
+SHARED_FIELDS = ("melody", "composer", "arranger", "notes")
+
+
+def expand_songs(
+    data: Union[List[Dict[str, Any]], Dict[str, Any]],
+) -> List[Dict[str, Any]]:
+    """
+    The songs of songs.json with the metadata they share filled in from their
+    parent records, interning the shared values so that each distinct value
+    is one string in memory.
+    """
+    if isinstance(data, dict):
+        parents = [
+            dict(
+                parent,
+                notes=(
+                    None if parent["notes"] is None else data["notes"][parent["notes"]]
+                ),
+            )
+            for parent in data["parents"]
+        ]
+        songs = []
+        for record in data["songs"]:
+            if "parent" not in record:
+                songs.append(record)
+                continue
+            song = dict(parents[record["parent"]])
+            song.update(record)
+            del song["parent"]
+            songs.append(song)
+    else:
+        # Written before songs.json was normalized
+        songs = data
+
+    for song in songs:
+        for field in SHARED_FIELDS:
+            if isinstance(song.get(field), str):
+                song[field] = sys.intern(song[field])
+    return songs
+
+
+def song_key(song: Dict[str, Any]) -> str:
+    """Stable key of a song: its id, or else its name for older extractions."""
+    return str(song.get("id") or song.get("name", ""))
+
+
+def content_hash(song: Dict[str, Any]) -> str:
+    """Hash of a song's content from the extractor, or computed if missing."""
+    return (
+        song.get("content_hash")
+        or hashlib.sha256(
+            json.dumps(song, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:16]
+    )
+
+
+class SongBackend:
+    """
+    Where songs are kept and searched. Songs are referred to by their index.
+
+    Only searching is required: the defaults go without snippets,
+    suggestions, related songs, completions and popularity.
+    """
+
+    def song_count(self) -> int:
+        """Number of songs."""
+        raise NotImplementedError
+
+    def song(self, idx: int) -> Dict[str, Any]:
+        """The song at an index."""
+        raise NotImplementedError
+
+    def key_of(self, idx: int) -> str:
+        """Stable key of the song at an index, see `find`."""
+        return song_key(self.song(idx))
+
+    def version_of(self, idx: int) -> str:
+        """Key and content hash of the song at an index, which change with it."""
+        return f"{self.key_of(idx)}@{content_hash(self.song(idx))}"
+
+    def find(self, key: str) -> Optional[int]:
+        """Index of the song with a stable key, or None if it's gone."""
+        return None
+
+    def search_hits(self, query: str, limit: int = 10) -> List[SearchHit]:
+        """Search for songs matching the query, best first."""
+        raise NotImplementedError
+
+    def find_titles(self, titles: List[str]) -> List[Optional[SearchHit]]:
+        """The best match of each song title, or None for titles matching nothing."""
+        return [next(iter(self.search_hits(title, 1)), None) for title in titles]
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Search for songs matching the query, with their lyrics."""
+        return [
+            hit.song if "lyrics" in hit.song else self.song(hit.index)
+            for hit in self.search_hits(query, limit)
+        ]
+
+    def snippet(
+        self, hit: SearchHit, terms: FrozenSet[str], width: int = 50
+    ) -> Optional[str]:
+        """HTML snippet of where a hit matched the lyrics, if it did."""
+        return hit.preview
+
+    def suggest(self, query: str, limit: int = 3) -> List[SearchHit]:
+        """Songs resembling a query that found nothing."""
+        return []
+
+    def related(self, idx: int) -> List[SearchHit]:
+        """The songs most similar to a song."""
+        return []
+
+    def complete(self, prefix: str) -> Optional[Tuple[int, ...]]:
+        """The best songs for a typed prefix, or None to search instead."""
+        return None
+
+    def set_popularity(self, views: Dict[str, int]) -> None:
+        """Use the views of each song name in ranking."""
+
+    def most_popular(self, limit: int) -> List[int]:
+        """Indexes of the most viewed songs."""
+        return []
+
+    def versions(self) -> Dict[str, str]:
+        """Version of each songbook collection."""
+        return {}
+
+    def reload_changed(self) -> List[str]:
+        """Reload the collections whose version changed, returning their names."""
+        return []
+
+    def compact(self) -> None:
+        """Tidy up the indexes after reloads, meant to run in the background."""
+
+    def load_timings(self) -> Dict[str, float]:
+        """Seconds spent on each stage of opening the songs, for startup reports."""
+        return {}
+
+    def after_fork(self) -> None:
+        """Drop what can't be shared with the process this one was forked from."""
+
+
+# zlib refers back at most this far, so longer preset dictionaries are cut
+ZDICT_SIZE = 32 * 1024
+# A word with what follows it, the unit of the preset dictionary
+ZDICT_WORD = re.compile(r"\w+\W{0,2}")
+
+
+def train_zdict(texts: List[str], size: int = ZDICT_SIZE) -> bytes:
+    """
+    Preset dictionary for compressing each text on its own: the words found
+    in several texts, those saving the most last since zlib reaches the
+    nearest bytes most cheaply.
+    """
+    counts: Counter = Counter()
+    for text in texts:
+        counts.update(set(ZDICT_WORD.findall(text)))
+    chosen = []
+    total = 0
+    for word, count in sorted(
+        counts.items(), key=lambda item: (-(item[1] - 1) * len(item[0]), item[0])
+    ):
+        encoded = word.encode("utf-8")
+        if count < 2 or total + len(encoded) > size:
+            break
+        chosen.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(chosen))
+
+
+class CompressedLyrics:
+    """
+    Lyrics of each song compressed with zlib and a preset dictionary trained
+    on all of them, decompressed when asked for into a small LRU cache.
+    """
+
+    def __init__(self, texts: List[str], cache_size: int):
+        self.zdict = train_zdict(texts)
+        self.blocks = [self._compress(text) for text in texts]
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[int, str]" = OrderedDict()
+        # Songs are rendered in threads
+        self.lock = threading.Lock()
+
+    def _compress(self, text: str) -> bytes:
+        compressor = zlib.compressobj(9, zdict=self.zdict)
+        return compressor.compress(text.encode("utf-8")) + compressor.flush()
+
+    def get(self, idx: int) -> str:
+        """The lyrics of a song."""
+        with self.lock:
+            text = self.cache.get(idx)
+            if text is not None:
+                self.cache.move_to_end(idx)
+                return text
+            block = self.blocks[idx]
+        decompressor = zlib.decompressobj(zdict=self.zdict)
+        text = (decompressor.decompress(block) + decompressor.flush()).decode("utf-8")
+        with self.lock:
+            # Lyrics changed meanwhile aren't cached as the old text
+            if self.blocks[idx] is not block:
+                return text
+            self.cache[idx] = text
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return text
+
+    def put(self, idx: int, text: str) -> None:
+        """Store the lyrics of a changed or added song."""
+        block = self._compress(text)
+        with self.lock:
+            if idx == len(self.blocks):
+                self.blocks.append(block)
+            else:
+                self.blocks[idx] = block
+            self.cache.pop(idx, None)
+
+    def size(self) -> int:
+        """Bytes taken by the compressed lyrics and the dictionary."""
+        return len(self.zdict) + sum(len(block) for block in self.blocks)
+
+
+# Decompressed lyrics kept in memory when lyrics are compressed
+LYRICS_CACHE_SIZE = int(os.getenv("LYRICS_CACHE_SIZE", "256"))
+
+
+class SongDatabase(SongBackend):
     """Simple in-memory song database with search functionality."""
 
-    def __init__(self, songs_file: str = "songs.json"):
-        """Initialize the song database."""
+    def __init__(
+        self,
+        songs_file: str = "songs.json",
+        engine: str = "python",
+        compress_lyrics: bool = False,
+    ):
+        """
+        Initialize the song database.
+
+        `engine` selects how free text is scored: "python", or "numpy" which
+        needs numpy and scipy. With `compress_lyrics` the lyrics are kept
+        compressed and searches use only the indexes built from them.
+        """
+        self.engine = engine
+        self.compress_lyrics = compress_lyrics
+        # Lyrics of the songs when compressed, then left out of `songs`
+        self.lyrics: Optional[CompressedLyrics] = None
+        self.songs_file = songs_file
+        self.directory = os.path.dirname(songs_file)
+        # Name and version of the collection the songs were loaded from
+        self.collection = "songs"
+        self.version = ""
+        # Held while searching and while changing the indexes
+        self.lock = threading.RLock()
+        # Held while changing the songs or rebuilding what's derived from
+        # them, so that rebuilds can read them without holding up searches
+        self.update_lock = threading.RLock()
+        # Precomputed song similarities, read from next to the songs file, and
+        # the song index of each song in it
+        self.similarity: Optional[SimilarityIndex] = None
+        self.similarity_songs: List[int] = []
+        self.scorer: PythonScorer = PythonScorer(self)
         self.songs: List[Dict[str, Any]] = []
+        # Song index of each song key, and the indexes of deleted songs, which
+        # keep their place so that other indexes don't change
+        self.ids: Dict[str, int] = {}
+        self.deleted: Set[int] = set()
+        # First song with each lowercased name, for exact matches
+        self.name_lookup: Dict[str, int] = {}
+        # Lowercased name and tag-free lyrics for free text search
+        self.search_texts: List[Tuple[str, str]] = []
+        # Per-field inverted indexes: field -> word -> song indexes
+        self.field_index: Dict[str, Dict[str, Set[int]]] = {}
+        # Sorted words of each field for prefix lookups
+        self.field_vocab: Dict[str, List[str]] = {}
+        # Words of each field joined by single spaces, for phrase checks
+        self.field_texts: Dict[str, List[str]] = {}
+        # Positional lyrics index: word -> song index -> word positions
+        self.positions: Dict[str, Dict[int, List[int]]] = {}
+        # Word and line offsets of each song's lyrics
+        self.layouts: List[LyricsLayout] = []
+        # Typed prefix -> best songs to complete it with, best first
+        self.completions: Dict[str, Tuple[int, ...]] = {}
+        # Views of each song name, and the rank of each song among equally
+        # scored ones: more viewed songs first, then in song order
+        self.popularity: Dict[str, int] = {}
+        self.tie_order = array("I")
+        # Seconds spent loading and indexing the songs
+        self.timings: Dict[str, float] = {}
         self.load_songs(songs_file)
 
     def load_songs(self, songs_file: str) -> None:
         """Load songs from JSON file."""
+        info = read_collection(self.directory)
+        self.collection = info.get("name", "songs")
+        self.version = collection_version(self.directory)
+        started = time.perf_counter()
         try:
             with open(songs_file, "r", encoding="utf-8") as f:
-                self.songs = json.load(f)
+                self.songs = expand_songs(json.load(f))
             logger.info("Loaded %d songs from %s", len(self.songs), songs_file)
         except FileNotFoundError:
             logger.error("Songs file %s not found", songs_file)
@@ -51,231 +889,2424 @@ class SongDatabase:
             logger.error("Error parsing songs file: %s", e)
             self.songs = []
 
-    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        loaded = time.perf_counter()
+        self.lyrics = None
+        self.build_indexes()
+        self._load_similarity(list(range(len(self.songs))))
+        indexed = time.perf_counter()
+        self.timings = {"load": loaded - started, "index": indexed - loaded}
+        if self.compress_lyrics:
+            self._compress_all()
+            self.timings["compress"] = time.perf_counter() - indexed
+
+    def _compress_all(self) -> None:
+        """Move the lyrics of all songs to compressed storage."""
+        size = sum(len(song.get("lyrics", "").encode("utf-8")) for song in self.songs)
+        self.lyrics = CompressedLyrics(
+            [song.pop("lyrics", "") for song in self.songs], LYRICS_CACHE_SIZE
+        )
+        for idx in range(len(self.songs)):
+            self._drop_texts(idx)
+        logger.info(
+            "Compressed %d bytes of lyrics to %d bytes", size, self.lyrics.size()
+        )
+
+    def _drop_texts(self, idx: int) -> None:
+        """Drop the copies of a song's lyrics that searches don't need."""
+        self.layouts[idx].plain = ""
+        self.search_texts[idx] = (self.search_texts[idx][0], "")
+        self.field_texts["lyrics"][idx] = ""
+
+    def _load_similarity(self, songs: List[int]) -> None:
+        """Load the similarities of the songs in songs.json at the given indexes."""
+        self.similarity = SimilarityIndex.load(
+            os.path.join(self.directory, "similarity.json"),
+            [song_key(self.songs[idx]) for idx in songs],
+        )
+        self.similarity_songs = songs
+
+    def build_indexes(self) -> None:
+        """Build the search indexes for the loaded songs."""
+        self.deleted = set()
+        self.ids = {song_key(song): idx for idx, song in enumerate(self.songs)}
+        self.layouts = [
+            LyricsLayout.build(song.get("lyrics", "")) for song in self.songs
+        ]
+        self.search_texts = [
+            (song.get("name", "").lower(), layout.plain.lower())
+            for song, layout in zip(self.songs, self.layouts)
+        ]
+
+        self.field_index = {field: defaultdict(set) for field in SEARCH_FIELDS}
+        self.field_texts = {field: [] for field in SEARCH_FIELDS}
+        for idx, song in enumerate(self.songs):
+            for field in SEARCH_FIELDS:
+                words = tokenize(song.get(field) or "")
+                self.field_texts[field].append(" ".join(words))
+                for word in words:
+                    self.field_index[field][word].add(idx)
+
+        self.field_vocab = {
+            field: sorted(index) for field, index in self.field_index.items()
+        }
+
+        self.name_lookup = {}
+        for idx, (name, _) in enumerate(self.search_texts):
+            self.name_lookup.setdefault(name, idx)
+
+        self.scorer = self._build_scorer()
+
+        self.positions = defaultdict(lambda: defaultdict(list))
+        for idx, layout in enumerate(self.layouts):
+            for position, word in enumerate(layout.words()):
+                self.positions[word][idx].append(position)
+
+        self.order_by_popularity()
+
+    def _index(self, idx: int) -> None:
+        """Add the song at an index to the search indexes."""
+        song = self.songs[idx]
+        layout = LyricsLayout.build(song.get("lyrics", ""))
+        self.layouts[idx] = layout
+        self.search_texts[idx] = (song.get("name", "").lower(), layout.plain.lower())
+        for field in SEARCH_FIELDS:
+            words = tokenize(song.get(field) or "")
+            self.field_texts[field][idx] = " ".join(words)
+            index = self.field_index[field]
+            vocab = self.field_vocab[field]
+            for word in words:
+                if not index.get(word):
+                    # Words left without songs stay in the vocabulary until
+                    # compaction, so check before adding
+                    position = bisect_left(vocab, word)
+                    if position == len(vocab) or vocab[position] != word:
+                        vocab.insert(position, word)
+                index[word].add(idx)
+        for position, word in enumerate(layout.words()):
+            self.positions[word][idx].append(position)
+        self.name_lookup.setdefault(self.search_texts[idx][0], idx)
+
+    def _unindex(self, idx: int) -> None:
+        """Remove the song at an index from the search indexes."""
+        if self.lyrics is not None:
+            # Bring back the lyrics words dropped from memory to remove them
+            layout = LyricsLayout.build(self.lyrics.get(idx))
+            self.layouts[idx] = layout
+            self.field_texts["lyrics"][idx] = " ".join(tokenize(layout.plain))
+        name = self.search_texts[idx][0]
+        for field in SEARCH_FIELDS:
+            for word in set(self.field_texts[field][idx].split()):
+                self.field_index[field][word].discard(idx)
+            self.field_texts[field][idx] = ""
+        for word in set(self.layouts[idx].words()):
+            self.positions[word].pop(idx, None)
+        self.layouts[idx] = LyricsLayout.build("")
+        self.search_texts[idx] = ("", "")
+
+        if self.name_lookup.get(name) == idx:
+            del self.name_lookup[name]
+            for other, (other_name, _) in enumerate(self.search_texts):
+                if other_name == name:
+                    self.name_lookup[name] = other
+                    break
+
+    def apply_changes(self, changed: List[Dict[str, Any]], removed: List[str]) -> None:
         """
-        Search for songs matching the query.
+        Add or update songs and delete songs by their key, updating only
+        their postings. The songs keep their indexes; `compact` tidies up.
+        """
+        with self.update_lock, self.lock:
+            updated = set()
+            for key in removed:
+                idx = self.ids.pop(key, None)
+                if idx is not None:
+                    self._unindex(idx)
+                    self.deleted.add(idx)
+                    updated.add(idx)
+
+            for song in changed:
+                # Copied, the lyrics are moved out of it when compressed
+                song = dict(song)
+                idx = self.ids.get(song_key(song))
+                if idx is not None and content_hash(self.song(idx)) == content_hash(
+                    song
+                ):
+                    # Same content, nothing to reindex
+                    continue
+                if idx is None:
+                    # New songs go last, also among equally scored songs
+                    idx = len(self.songs)
+                    self.ids[song_key(song)] = idx
+                    self.songs.append(song)
+                    self.layouts.append(LyricsLayout.build(""))
+                    self.search_texts.append(("", ""))
+                    for field in SEARCH_FIELDS:
+                        self.field_texts[field].append("")
+                    self.tie_order.append(len(self.tie_order))
+                else:
+                    self._unindex(idx)
+                    self.songs[idx] = song
+                self._index(idx)
+                updated.add(idx)
+                if self.lyrics is not None:
+                    self.lyrics.put(idx, song.pop("lyrics", ""))
 
-        This is a simple text-based search that looks for the query
-        in song name and lyrics.
+            # Deleted songs have no words left, so their rows are cleared
+            self.scorer.update(updated)
+            if self.lyrics is not None:
+                for idx in updated:
+                    self._drop_texts(idx)
+
+    def reload_changed(self) -> List[str]:
+        """
+        Reload the songs if the collection version changed, applying only the
+        change set written by extract_songs.py when it's from this version.
         """
-        if not query.strip():
-            return self.songs[:limit]
+        version = collection_version(self.directory)
+        if version == self.version:
+            return []
 
-        query_lower = query.lower()
-        matches = []
+        try:
+            with open(
+                os.path.join(self.directory, "changes.json"), encoding="utf-8"
+            ) as f:
+                changes = json.load(f)
+            if (
+                changes.get("from_version") != self.version
+                or changes.get("to_version") != version
+            ):
+                raise ValueError("change set is for other versions")
+            with open(self.songs_file, encoding="utf-8") as f:
+                songs = expand_songs(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.info("Reloading all of %s: %s", self.collection, e)
+            with self.update_lock, self.lock:
+                self.load_songs(self.songs_file)
+            return [self.collection]
 
-        for song in self.songs:
-            # Calculate relevance score
-            score = 0
+        by_key = {song_key(song): song for song in songs}
+        changed = [
+            by_key[key]
+            for key in changes.get("added", []) + changes.get("changed", [])
+            if key in by_key
+        ]
+        self.apply_changes(changed, changes.get("removed", []))
+        self._load_similarity([self.ids[song_key(song)] for song in songs])
+        self.version = version
+        logger.info(
+            "Applied %d added, %d changed and %d removed songs to %s",
+            len(changes.get("added", [])),
+            len(changes.get("changed", [])),
+            len(changes.get("removed", [])),
+            self.collection,
+        )
+        return [self.collection]
 
-            # If exact match, return immediately
-            if query_lower == song.get("name", "").lower():
-                return [song]
+    def compact(self) -> None:
+        """
+        Drop the words left without songs by changes, and redo the
+        popularity order and completions to cover the changed songs.
+        """
+        with self.update_lock:
+            with self.lock:
+                for field, index in self.field_index.items():
+                    empty = [word for word, songs in index.items() if not songs]
+                    for word in empty:
+                        del index[word]
+                    if empty:
+                        self.field_vocab[field] = sorted(index)
+                for word in [
+                    word for word, songs in self.positions.items() if not songs
+                ]:
+                    del self.positions[word]
+                self.scorer.update(())
+            self.order_by_popularity()
 
-            # Higher score for name matches
-            if query_lower in song.get("name", "").lower():
-                score += 10
+    def versions(self) -> Dict[str, str]:
+        return {self.collection: self.version}
 
-            # Lower score for lyrics matches
-            if query_lower in song.get("lyrics", "").lower():
-                score += 1
+    def load_timings(self) -> Dict[str, float]:
+        return self.timings
 
-            # Add to results if there's a match
-            if score > 0:
-                matches.append((score, song))
+    def set_popularity(self, views: Dict[str, int]) -> None:
+        """Use the views of each song name to break ties in rankings."""
+        with self.update_lock:
+            self.popularity = dict(views)
+            self.order_by_popularity()
 
-        # Sort by relevance and return top results
-        matches.sort(reverse=True, key=lambda x: x[0])
-        return [song for _, song in matches[:limit]]
+    def order_by_popularity(self) -> None:
+        """
+        Rank songs by their popularity for ties, and redo the completions.
+        Both are built holding only `update_lock`, and swapped in under the
+        search lock, so that searches don't wait for the rebuild.
+        """
+        by_popularity = sorted(
+            range(len(self.songs)),
+            key=lambda idx: (-self.popularity.get(self.songs[idx].get("name"), 0), idx),
+        )
+        tie_order = array("I", bytes(4 * len(self.songs)))
+        for rank, idx in enumerate(by_popularity):
+            tie_order[idx] = rank
+        completions = self.build_completions(tie_order)
+        with self.lock:
+            self.tie_order = tie_order
+            self.completions = completions
 
+    def most_popular(self, limit: int) -> List[int]:
+        """Indexes of the most viewed songs that have been viewed at all."""
+        viewed = [
+            idx
+            for idx, song in enumerate(self.songs)
+            if self.popularity.get(song.get("name"), 0) > 0 and idx not in self.deleted
+        ]
+        return sorted(viewed, key=self.tie_order.__getitem__)[:limit]
 
-# Global song database instance
-song_db = SongDatabase()
+    def build_completions(self, tie_order: array) -> Dict[str, Tuple[int, ...]]:
+        """
+        Precompute the best songs for every prefix of the song names and of
+        the most common lyrics words, so completing a prefix is a lookup.
+        Songs completing a prefix equally well are ordered by `tie_order`.
+        """
+        # prefix -> song index -> weight of its best completion
+        weights: Dict[str, Dict[int, int]] = defaultdict(dict)
 
+        def add(text: str, songs: Set[int], weight: int) -> None:
+            for end in range(1, min(len(text), MAX_COMPLETION_PREFIX) + 1):
+                best = weights[text[:end]]
+                for idx in songs:
+                    if best.get(idx, 0) < weight:
+                        best[idx] = weight
 
-def escape_html(text: str) -> str:
-    """Remove HTML tags from text."""
-    # Remove HTML tags
-    clean_text = re.sub(r"<[^>]+>", "", text)
-    return clean_text
+        for idx, (name, _) in enumerate(self.search_texts):
+            name = normalize_query(name)
+            add(name, {idx}, COMPLETE_NAME_START)
+            # Later words of the name, completed up to the end of the name
+            for match in WORD.finditer(name):
+                if match.start() > 0:
+                    add(name[match.start() :], {idx}, COMPLETE_NAME_WORD)
 
+        lyrics_index = self.field_index["lyrics"]
+        common_words = heapq.nlargest(
+            COMPLETION_LYRICS_WORDS,
+            lyrics_index,
+            key=lambda word: (len(lyrics_index[word]), word),
+        )
+        for word in common_words:
+            add(word, lyrics_index[word], COMPLETE_LYRICS_WORD)
 
-def truncate_message(text: str, max_length: int = 4000) -> str:
-    """Truncate message if it's too long for Telegram."""
-    if len(text) <= max_length:
-        return text
+        return {
+            prefix: tuple(
+                idx
+                for idx, _ in heapq.nsmallest(
+                    COMPLETIONS_PER_PREFIX,
+                    songs.items(),
+                    key=lambda item: (-item[1], tie_order[item[0]]),
+                )
+            )
+            for prefix, songs in weights.items()
+        }
 
-    # Find a good place to cut (try to cut at a line break)
-    truncated = text[:max_length]
-    last_newline = truncated.rfind("\n")
+    def complete(self, prefix: str) -> Optional[Tuple[int, ...]]:
+        """
+        The best songs for a typed prefix, or None if the prefix isn't
+        precomputed and needs a full search.
+        """
+        prefix = normalize_query(prefix)
+        if len(prefix) > MAX_COMPLETION_PREFIX:
+            return None
+        return self.completions.get(prefix)
+
+    def _phrase_matches(self, phrase: str, partial: bool = False) -> Dict[int, int]:
+        """
+        Songs whose lyrics contain the words of `phrase` in a row, mapped to
+        the position of the first match. With `partial` the first word may
+        end a longer word and the last one start a longer word, like when
+        finding the phrase in the lyrics text.
+        """
+        words = tokenize(phrase)
+        postings = [self.positions.get(word) for word in words]
+        if partial and len(words) > 1:
+            first, last = words[0], words[-1]
+            containing = self.scorer.containing
+            postings[0] = self._merged_positions(
+                word for word in containing("lyrics", first) if word.endswith(first)
+            )
+            postings[-1] = self._merged_positions(
+                word for word in containing("lyrics", last) if word.startswith(last)
+            )
+        if not postings or not all(postings):
+            return {}
+
+        # Intersect the songs starting from the rarest word
+        songs = set.intersection(*(set(p) for p in sorted(postings, key=len)))
+        matches = {}
+        for idx in songs:
+            starts = set(postings[0][idx])
+            for offset, posting in enumerate(postings[1:], 1):
+                starts &= {position - offset for position in posting[idx]}
+                if not starts:
+                    break
+            if starts:
+                matches[idx] = min(starts)
+        return matches
+
+    def _merged_positions(self, words: Iterable[str]) -> Dict[int, List[int]]:
+        """Positions of any of the lyrics words in each song."""
+        merged: Dict[int, List[int]] = defaultdict(list)
+        for word in words:
+            for idx, positions in self.positions.get(word, {}).items():
+                merged[idx].extend(positions)
+        return merged
+
+    def _near_matches(self, phrase: str, distance: int) -> Dict[int, int]:
+        """
+        Songs whose lyrics contain all words of `phrase` within `distance`
+        words of the first one, mapped to the position of the first match.
+        """
+        words = sorted(set(tokenize(phrase)))
+        postings = [self.positions.get(word) for word in words]
+        if not postings or not all(postings):
+            return {}
+
+        postings.sort(key=len)
+        songs = set.intersection(*(set(p) for p in postings))
+        matches = {}
+        for idx in songs:
+            for anchor in postings[0][idx]:
+                if all(
+                    any(abs(position - anchor) <= distance for position in p[idx])
+                    for p in postings[1:]
+                ):
+                    matches[idx] = anchor
+                    break
+        return matches
+
+    def _build_scorer(self) -> PythonScorer:
+        """Create the free text scorer selected with `engine`."""
+        try:
+            return SCORERS[self.engine](self)
+        except ImportError as e:
+            logger.warning(
+                "Search engine %s not available (%s), using python", self.engine, e
+            )
+        except KeyError:
+            logger.warning("Unknown search engine %s, using python", self.engine)
+        return PythonScorer(self)
+
+    def _prefix_matches(self, field: str, prefix: str) -> Set[int]:
+        """Songs that have a word starting with `prefix` in the field."""
+        vocab = self.field_vocab[field]
+        index = self.field_index[field]
+        matches: Set[int] = set()
+        for i in range(bisect_left(vocab, prefix), len(vocab)):
+            if not vocab[i].startswith(prefix):
+                break
+            matches |= index[vocab[i]]
+        return matches
+
+    def _field_matches(self, field: str, value: str) -> Set[int]:
+        """Songs whose field contains the words of `value` in order."""
+        words = tokenize(value)
+        if not words:
+            return set()
+
+        # Look up candidates from the index, the last word may be unfinished
+        candidates = set(self.field_index[field].get(words[-1], ()))
+        candidates |= self._prefix_matches(field, words[-1])
+        for word in words[:-1]:
+            candidates &= self.field_index[field].get(word, set())
+            if not candidates:
+                return candidates
+
+        if len(words) > 1:
+            phrase = " ".join(words)
+            if field == "lyrics" and self.lyrics is not None:
+                # The word lists of compressed lyrics aren't kept, the
+                # positional index has the words in order
+                return candidates & set(self._phrase_matches(phrase, partial=True))
+            texts = self.field_texts[field]
+            candidates = {idx for idx in candidates if phrase in texts[idx]}
+
+        return candidates
+
+    def song_count(self) -> int:
+        # Deleted songs keep their place in `songs`
+        return len(self.songs) - len(self.deleted)
+
+    def song(self, idx: int) -> Dict[str, Any]:
+        if self.lyrics is not None:
+            return dict(self.songs[idx], lyrics=self.lyrics.get(idx))
+        return self.songs[idx]
+
+    def key_of(self, idx: int) -> str:
+        return song_key(self.songs[idx])
+
+    def version_of(self, idx: int) -> str:
+        song = self.songs[idx]
+        if "content_hash" not in song:
+            # Songs extracted without a hash have it computed with their lyrics
+            song = self.song(idx)
+        return f"{song_key(song)}@{content_hash(song)}"
+
+    def find(self, key: str) -> Optional[int]:
+        return self.ids.get(key)
+
+    def search_hits(self, query: str, limit: int = 10) -> List[SearchHit]:
+        with self.lock:
+            return self._search_hits(query, limit)
+
+    def find_titles(self, titles: List[str]) -> List[Optional[SearchHit]]:
+        # One lock for the whole list, and each distinct title looked up once
+        best: Dict[str, Optional[SearchHit]] = {}
+        with self.lock:
+            for title in titles:
+                key = normalize_query(title)
+                if key not in best:
+                    best[key] = next(iter(self._search_hits(title, 1)), None)
+        return [best[normalize_query(title)] for title in titles]
+
+    def _search_hits(self, query: str, limit: int = 10) -> List[SearchHit]:
+        """
+        Search for songs matching the query.
+
+        Free text is looked up from song names and lyrics, field-qualified
+        parts (see `compile_query`) from the per-field indexes and phrases
+        from the positional lyrics index.
+        """
+        compiled = compile_query(query)
+        if compiled.is_empty():
+            indexes = sorted(
+                set(range(len(self.songs))) - self.deleted,
+                key=self.tie_order.__getitem__,
+            )
+            return [SearchHit(self.songs[idx], 0, idx) for idx in indexes[:limit]]
+
+        # Narrow down candidates with the indexes first
+        candidates: Optional[Set[int]] = None
+        # Word position and length in words of a lyrics match for each candidate
+        lyrics_matches: Dict[int, Tuple[int, int]] = {}
+
+        def narrow(matches: Set[int]) -> bool:
+            nonlocal candidates
+            candidates = matches if candidates is None else candidates & matches
+            return bool(candidates)
+
+        def add_lyrics_matches(matches: Dict[int, int], length: int) -> None:
+            for idx, position in matches.items():
+                lyrics_matches.setdefault(idx, (position, length))
+
+        for field, value in compiled.fields:
+            if not narrow(self._field_matches(field, value)):
+                return []
+
+        for phrase in compiled.phrases:
+            # A phrase may match the name or the lyrics
+            in_lyrics = self._phrase_matches(phrase)
+            add_lyrics_matches(in_lyrics, len(tokenize(phrase)))
+            if not narrow(set(in_lyrics) | self._field_matches("name", phrase)):
+                return []
+
+        for phrase, distance in compiled.near:
+            in_lyrics = self._near_matches(phrase, distance)
+            add_lyrics_matches(in_lyrics, 1)
+            if not narrow(set(in_lyrics)):
+                return []
+
+        query_lower = compiled.text
+        if not query_lower:
+            # Only the field and phrase parts, which all candidates match
+            indexes = sorted(candidates or (), key=self.tie_order.__getitem__)
+            ranked = [(1, idx) for idx in indexes[:limit]]
+            return [
+                self._hit(score, idx, lyrics_matches.get(idx)) for score, idx in ranked
+            ]
+
+        # If exact match, return immediately
+        exact = self.name_lookup.get(query_lower)
+        if exact is not None and (candidates is None or exact in candidates):
+            hit = self._hit(0, exact, lyrics_matches.get(exact), query_lower)
+            hit.exact = True
+            return [hit]
+
+        # Multi-word text also matches lyrics regardless of punctuation and
+        # lines, with the words at the ends partial like text found in the
+        # lyrics, so that compressed lyrics match the same
+        text_in_lyrics = (
+            self._phrase_matches(query_lower, partial=True)
+            if " " in query_lower
+            else {}
+        )
+
+        def verify(idx: int) -> int:
+            """Exact score of a song for text that isn't a single word."""
+            name, lyrics = self.search_texts[idx]
+            score = 0
+            # Higher score for name matches
+            if query_lower in name:
+                score += NAME_SCORE
+            # Lower score for lyrics matches, only from the indexes when the
+            # lyrics are compressed
+            if query_lower in lyrics or idx in text_in_lyrics:
+                score += LYRICS_SCORE
+            return score
+
+        words = tokenize(query_lower)
+        if words:
+            single_word = words == [query_lower]
+            ranked = self.scorer.rank(
+                words, candidates, limit, None if single_word else verify
+            )
+        else:
+            # Nothing to look up from the indexes, check every candidate
+            indexes = range(len(self.songs)) if candidates is None else candidates
+            scored = [(verify(idx), idx) for idx in indexes]
+            ranked = heapq.nsmallest(
+                limit,
+                [x for x in scored if x[0] > 0],
+                key=lambda x: (-x[0], self.tie_order[x[1]]),
+            )
+
+        text_length = len(words)
+        hits = []
+        for score, idx in ranked:
+            # Where the lyrics matched, as a word span or a character offset
+            word_span = lyrics_matches.get(idx)
+            if word_span is None and idx in text_in_lyrics:
+                word_span = (text_in_lyrics[idx], text_length)
+            hits.append(self._hit(score, idx, word_span, query_lower))
+        return hits
+
+    def _hit(
+        self,
+        score: int,
+        idx: int,
+        word_span: Optional[Tuple[int, int]],
+        text: str = "",
+    ) -> SearchHit:
+        """
+        Build a search hit, locating the lyrics match from the word span of
+        an indexed match, or else from where `text` appears in the lyrics.
+        """
+        hit = SearchHit(self.songs[idx], score, idx)
+        layout = self.layouts[idx]
+        if self.lyrics is not None:
+            # The lyrics are compressed, find the text in the indexes instead
+            offset = self._word_offset(idx, text) if text else -1
+        else:
+            offset = self.search_texts[idx][1].find(text) if text else -1
+        if word_span is not None:
+            position, words = word_span
+            hit.start = layout.word_starts[position]
+            hit.end = layout.word_ends[position + words - 1]
+            line = layout.line_of_word(position)
+        elif offset != -1:
+            hit.start, hit.end = offset, offset + len(text)
+            line = layout.line_of_offset(offset)
+        else:
+            return hit
+
+        if layout.line_numbers:
+            hit.verse, hit.line = layout.line_numbers[line]
+        return hit
+
+    def _word_offset(self, idx: int, text: str) -> int:
+        """
+        Offset of the first lyrics word of a song containing a single-word
+        text, like finding the text in the lyrics, or -1 if there's none.
+        """
+        if tokenize(text) != [text]:
+            return -1
+        first: Optional[Tuple[int, str]] = None
+        for word in self.scorer.containing("lyrics", text):
+            positions = self.positions.get(word, {}).get(idx)
+            if positions and (first is None or positions[0] < first[0]):
+                first = (positions[0], word)
+        if first is None:
+            return -1
+        position, word = first
+        return self.layouts[idx].word_starts[position] + word.find(text)
+
+    def suggest(self, query: str, limit: int = 3) -> List[SearchHit]:
+        """Songs with a name or first verse resembling a query that found nothing."""
+        if self.similarity is None:
+            return []
+        text = compile_query(query).text or normalize_query(query)
+        songs = self.similarity_songs
+        return [
+            SearchHit(self.songs[songs[position]], 0, songs[position])
+            for _, position in self.similarity.similar(
+                text, limit, SUGGESTION_MIN_SCORE
+            )
+        ]
+
+    def related(self, idx: int) -> List[SearchHit]:
+        """The songs most similar to a song by name and first verse."""
+        if self.similarity is None:
+            return []
+        songs = self.similarity_songs
+        try:
+            position = songs.index(idx)
+        except ValueError:
+            return []
+        return [
+            SearchHit(self.songs[songs[other]], 0, songs[other])
+            for other in self.similarity.related[position]
+        ]
+
+    def snippet(
+        self, hit: SearchHit, terms: FrozenSet[str], width: int = 50
+    ) -> Optional[str]:
+        """
+        Cut the lyrics line of a hit around the match, as HTML with the match
+        and other query words in bold. Returns None if the lyrics didn't match.
+        """
+        if hit.start is None or hit.end is None:
+            return None
+
+        layout = self.layouts[hit.index]
+        plain = layout.plain
+        if self.lyrics is not None:
+            plain = escape_html(self.lyrics.get(hit.index))
+        line_start = layout.line_offsets[layout.line_of_offset(hit.start)]
+        line_end = plain.find("\n", hit.start)
+        if line_end == -1:
+            line_end = len(plain)
+        match_end = min(hit.end, line_end)
+
+        # Show some context before the match, starting at a word boundary
+        start = max(line_start, hit.start - width // 3)
+        if start > line_start:
+            space = plain.find(" ", start, hit.start)
+            start = space + 1 if space != -1 else hit.start
+        end = min(line_end, max(match_end, start + width))
+        if end < line_end:
+            space = plain.rfind(" ", match_end, end)
+            end = space if space != -1 else end
+
+        # Bold the match and the query words around it
+        bold = [(hit.start, match_end)]
+        first = bisect_left(layout.word_starts, start)
+        for position in range(first, len(layout.word_starts)):
+            word_start = layout.word_starts[position]
+            word_end = layout.word_ends[position]
+            if word_end > end:
+                break
+            if (word_end <= hit.start or word_start >= match_end) and plain[
+                word_start:word_end
+            ].lower() in terms:
+                bold.append((word_start, word_end))
+        bold.sort()
+
+        parts = ["…"] if start > line_start else []
+        cursor = start
+        for bold_start, bold_end in bold:
+            parts.append(html.escape(plain[cursor:bold_start]))
+            parts.append(f"<b>{html.escape(plain[bold_start:bold_end])}</b>")
+            cursor = bold_end
+        parts.append(html.escape(plain[cursor:end]))
+        if end < line_end:
+            parts.append("…")
+        return "".join(parts).strip()
+
+
+# Columns of the full text index, in the order of their bm25 weights
+FTS_COLUMNS = ("name", "melody", "composer", "arranger", "lyrics")
+FTS_WEIGHTS = (float(NAME_SCORE), 1.0, 1.0, 1.0, float(LYRICS_SCORE))
+
+
+def fts_words(text: str, column: str = "{name lyrics}") -> str:
+    """FTS5 expression for words that start words of a column, in any order."""
+    words = " AND ".join(f'"{word}"*' for word in tokenize(text))
+    return f"{column} : ({words})" if words else ""
+
+
+class SqliteSongDatabase(SongBackend):
+    """
+    Songs in the SQLite file written by extract_songs.py, searched with its
+    FTS5 index and ranked with bm25. Only the songs that searches return are
+    read into memory.
+    """
+
+    def __init__(self, db_file: str = "songs.sqlite3"):
+        self.db_file = db_file
+        self.directory = os.path.dirname(db_file)
+        self.collection = read_collection(self.directory).get("name", "songs")
+        self.version = collection_version(self.directory)
+        # SQLite connections can't be shared between the search threads
+        self.local = threading.local()
+        self.popularity: Dict[str, int] = {}
+        started = time.perf_counter()
+        self._count_songs()
+        self.timings = {"load": time.perf_counter() - started}
+
+    def _count_songs(self) -> None:
+        try:
+            (self.count,) = (
+                self._connection().execute("SELECT COUNT(*) FROM songs").fetchone()
+            )
+            logger.info("Opened %d songs from %s", self.count, self.db_file)
+        except sqlite3.Error as e:
+            logger.error("Error opening songs database %s: %s", self.db_file, e)
+            self.count = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.db_file}?mode=ro", uri=True)
+            self.local.connection = connection
+        return connection
+
+    def song_count(self) -> int:
+        return self.count
+
+    def song(self, idx: int) -> Dict[str, Any]:
+        row = (
+            self._connection()
+            .execute("SELECT data FROM songs WHERE id = ?", (idx + 1,))
+            .fetchone()
+        )
+        if row is None:
+            raise IndexError(idx)
+        return json.loads(row[0])
+
+    def _metadata(self, idx: int) -> Tuple[str, Optional[str]]:
+        """Key and content hash of a song, read without decoding the song."""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT song_id, json_extract(data, '$.content_hash') FROM songs "
+                "WHERE id = ?",
+                (idx + 1,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise IndexError(idx)
+        return row
+
+    def key_of(self, idx: int) -> str:
+        return self._metadata(idx)[0]
+
+    def version_of(self, idx: int) -> str:
+        key, hashed = self._metadata(idx)
+        if hashed is None:
+            # Songs extracted without a hash have it computed with their lyrics
+            return f"{key}@{content_hash(self.song(idx))}"
+        return f"{key}@{hashed}"
+
+    def search_hits(self, query: str, limit: int = 10) -> List[SearchHit]:
+        """
+        Search for songs matching the query, translated to an FTS5 expression.
+
+        Free text words match the beginnings of name and lyrics words, and
+        field values the beginnings of words of their field.
+        """
+        connection = self._connection()
+        compiled = compile_query(query)
+        if compiled.is_empty():
+            rows = connection.execute(
+                "SELECT id, data FROM songs ORDER BY id LIMIT ?", (limit,)
+            )
+            return [SearchHit(json.loads(data), 0, idx - 1) for idx, data in rows]
+
+        parts = [fts_words(value, field) for field, value in compiled.fields]
+        for phrase in compiled.phrases:
+            words = " ".join(tokenize(phrase))
+            parts.append(f'{{name lyrics}} : "{words}"')
+        for phrase, distance in compiled.near:
+            words = " ".join(f'"{word}"' for word in tokenize(phrase))
+            parts.append(f"lyrics : NEAR({words}, {distance})")
+        constraints = " AND ".join(part for part in parts if part)
+
+        try:
+            # If exact name match, return it alone
+            if compiled.text:
+                row = connection.execute(
+                    "SELECT id, data FROM songs WHERE name_key = ? AND (? = '' "
+                    "OR id IN (SELECT rowid FROM songs_fts WHERE songs_fts MATCH ?))"
+                    " ORDER BY id LIMIT 1",
+                    (compiled.text, constraints, constraints or "x"),
+                ).fetchone()
+                if row is not None:
+                    return [SearchHit(json.loads(row[1]), 0, row[0] - 1, exact=True)]
+
+            expression = " AND ".join(
+                part for part in (constraints, fts_words(compiled.text)) if part
+            )
+            if not expression:
+                return []
+            rows = connection.execute(
+                "SELECT songs.id, songs.data, snippet(songs_fts, 4, char(2), "
+                "char(3), '…', 10), "
+                f"bm25(songs_fts, {', '.join(map(str, FTS_WEIGHTS))}) AS rank "
+                "FROM songs_fts JOIN songs ON songs.id = songs_fts.rowid "
+                "WHERE songs_fts MATCH ? ORDER BY rank, songs.id LIMIT ?",
+                (expression, limit),
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error("Error searching songs for %r: %s", query, e)
+            return []
+
+        hits = []
+        for idx, data, snippet, rank in rows:
+            # bm25 is lower for better matches, and its negation is comparable
+            # between the shards of a sharded database
+            hit = SearchHit(json.loads(data), -rank, idx - 1)
+            # Snippets of lyrics that didn't match have nothing marked
+            if "\x02" in snippet:
+                hit.preview = (
+                    html.escape(" ".join(snippet.split()))
+                    .replace("\x02", "<b>")
+                    .replace("\x03", "</b>")
+                )
+            hits.append(hit)
+        return hits
+
+    def set_popularity(self, views: Dict[str, int]) -> None:
+        self.popularity = dict(views)
+
+    def most_popular(self, limit: int) -> List[int]:
+        names = [
+            name
+            for name, _ in sorted(self.popularity.items(), key=lambda x: -x[1])[:limit]
+        ]
+        rows = self._connection().execute(
+            "SELECT name, MIN(id) FROM songs WHERE name IN "
+            f"({', '.join('?' * len(names))}) GROUP BY name",
+            names,
+        )
+        first = dict(rows)
+        return [first[name] - 1 for name in names if name in first]
+
+    def load_timings(self) -> Dict[str, float]:
+        return self.timings
+
+    def after_fork(self) -> None:
+        # Connections opened before forking belong to the parent process
+        self.local = threading.local()
+
+    def find(self, key: str) -> Optional[int]:
+        try:
+            row = (
+                self._connection()
+                .execute("SELECT id FROM songs WHERE song_id = ?", (key,))
+                .fetchone()
+            )
+        except sqlite3.Error:
+            # Databases written before songs had ids
+            return None
+        return row[0] - 1 if row is not None else None
+
+    def versions(self) -> Dict[str, str]:
+        return {self.collection: self.version}
+
+    def reload_changed(self) -> List[str]:
+        """
+        Reopen the database if the collection version changed. The extractor
+        replaces the whole file, so there's no change set to apply.
+        """
+        version = collection_version(self.directory)
+        if version == self.version:
+            return []
+        # Threads open new connections, searches running now finish on the old
+        self.local = threading.local()
+        self._count_songs()
+        self.version = version
+        return [self.collection]
+
+
+def open_backend(directory: Optional[str] = None) -> SongBackend:
+    """
+    Open the songs extracted to a directory, or the working directory's songs,
+    with the backend chosen with SONG_BACKEND.
+    """
+    backend = os.getenv("SONG_BACKEND", "memory")
+    if backend == "sqlite":
+        if directory is None:
+            return SqliteSongDatabase(os.getenv("SONGS_DB", "songs.sqlite3"))
+        return SqliteSongDatabase(os.path.join(directory, "songs.sqlite3"))
+    if backend != "memory":
+        logger.warning("Unknown song backend %r, using memory", backend)
+    return SongDatabase(
+        os.path.join(directory or "", "songs.json"),
+        engine=os.getenv("SEARCH_ENGINE", "python"),
+        compress_lyrics=os.getenv("LYRICS_COMPRESSION", "") == "zlib",
+    )
+
+
+# Restricts a query to one collection of a sharded database
+COLLECTION_FILTER = re.compile(
+    r'(?<!\S)(?:kokoelma|collection):\s*(?:"([^"]*)"?|(\S+))', flags=re.IGNORECASE
+)
+# Spacing of the song indexes of shards, so that reloading one shard doesn't
+# change the indexes of the others
+SHARD_STRIDE = 1 << 20
+
+
+def interleave(lists: List[List[Any]], limit: int) -> List[Any]:
+    """Take items from each list in turn, up to `limit` items."""
+    merged: List[Any] = []
+    longest = max((len(items) for items in lists), default=0)
+    for i in range(longest):
+        merged.extend(items[i] for items in lists if i < len(items))
+    return merged[:limit]
+
+
+class ShardedSongDatabase(SongBackend):
+    """
+    Several songbook collections, each in its own backend (shard) with its own
+    version. Searches run on all shards at once and their results are merged.
+
+    The index of a song is its shard's number times `SHARD_STRIDE` plus its
+    index within the shard.
+    """
+
+    def __init__(self, collections: Dict[str, str]):
+        # Collection names and shards, in the order results are merged
+        self.names = list(collections)
+        self.shards = [open_backend(directory) for directory in collections.values()]
+        self.pool = ThreadPoolExecutor(
+            max_workers=len(self.shards), thread_name_prefix="shard"
+        )
+
+    def _split(self, idx: int) -> Tuple[int, int]:
+        """Shard number and index within the shard of a song."""
+        return divmod(idx, SHARD_STRIDE)
+
+    def _globalize(self, shard: int, hits: List[SearchHit]) -> List[SearchHit]:
+        """Give hits from a shard database-wide indexes and their collection."""
+        for hit in hits:
+            hit.index += shard * SHARD_STRIDE
+            hit.song = dict(hit.song, collection=self.names[shard])
+        return hits
+
+    def song_count(self) -> int:
+        return sum(shard.song_count() for shard in self.shards)
+
+    def song(self, idx: int) -> Dict[str, Any]:
+        shard, local = self._split(idx)
+        return dict(self.shards[shard].song(local), collection=self.names[shard])
+
+    def key_of(self, idx: int) -> str:
+        """Key of the song within its shard, prefixed with the collection name."""
+        shard, local = self._split(idx)
+        return f"{self.names[shard]}/{self.shards[shard].key_of(local)}"
+
+    def version_of(self, idx: int) -> str:
+        shard, local = self._split(idx)
+        return f"{self.names[shard]}/{self.shards[shard].version_of(local)}"
+
+    def find(self, key: str) -> Optional[int]:
+        name, _, shard_key = key.partition("/")
+        if name not in self.names:
+            return None
+        shard = self.names.index(name)
+        idx = self.shards[shard].find(shard_key)
+        return None if idx is None else shard * SHARD_STRIDE + idx
+
+    def search_hits(self, query: str, limit: int = 10) -> List[SearchHit]:
+        """
+        Search all shards concurrently, or only the one named with a
+        `kokoelma:` filter, and merge their top results.
+        """
+        shards = range(len(self.shards))
+        match = COLLECTION_FILTER.search(query)
+        if match is not None:
+            name = (match.group(1) or match.group(2) or "").strip().lower()
+            shards = [i for i in shards if self.names[i] == name]
+            query = query[: match.start()] + query[match.end() :]
+
+        results = self.pool.map(
+            lambda i: self._globalize(i, self.shards[i].search_hits(query, limit)),
+            shards,
+        )
+        hits = [hit for shard_hits in results for hit in shard_hits]
+
+        # A song named exactly like the query beats everything else
+        exact = [hit for hit in hits if hit.exact]
+        if exact:
+            return exact[:limit]
+        # Stable sort keeps each shard's order and earlier shards first on ties
+        hits.sort(key=lambda hit: -hit.score)
+        return hits[:limit]
+
+    def find_titles(self, titles: List[str]) -> List[Optional[SearchHit]]:
+        def shard_titles(i: int) -> List[Optional[SearchHit]]:
+            hits = self.shards[i].find_titles(titles)
+            # Repeated titles share their hit, which is to be moved only once
+            unique = {id(hit): hit for hit in hits if hit is not None}
+            self._globalize(i, list(unique.values()))
+            return hits
+
+        results = list(self.pool.map(shard_titles, range(len(self.shards))))
+        best: List[Optional[SearchHit]] = []
+        for candidates in zip(*results):
+            found = [hit for hit in candidates if hit is not None]
+            # Exact names first, then the best score, earlier shards on ties
+            found.sort(key=lambda hit: (not hit.exact, -hit.score))
+            best.append(found[0] if found else None)
+        return best
+
+    def snippet(
+        self, hit: SearchHit, terms: FrozenSet[str], width: int = 50
+    ) -> Optional[str]:
+        shard, local = self._split(hit.index)
+        return self.shards[shard].snippet(replace(hit, index=local), terms, width)
+
+    def suggest(self, query: str, limit: int = 3) -> List[SearchHit]:
+        return interleave(
+            [
+                self._globalize(i, shard.suggest(query, limit))
+                for i, shard in enumerate(self.shards)
+            ],
+            limit,
+        )
+
+    def related(self, idx: int) -> List[SearchHit]:
+        shard, local = self._split(idx)
+        return self._globalize(shard, self.shards[shard].related(local))
+
+    def complete(self, prefix: str) -> Optional[Tuple[int, ...]]:
+        completions = []
+        for i, shard in enumerate(self.shards):
+            indexes = shard.complete(prefix)
+            if indexes is None:
+                return None
+            completions.append([i * SHARD_STRIDE + idx for idx in indexes])
+        return tuple(interleave(completions, COMPLETIONS_PER_PREFIX))
+
+    def set_popularity(self, views: Dict[str, int]) -> None:
+        for shard in self.shards:
+            shard.set_popularity(views)
+
+    def most_popular(self, limit: int) -> List[int]:
+        return interleave(
+            [
+                [i * SHARD_STRIDE + idx for idx in shard.most_popular(limit)]
+                for i, shard in enumerate(self.shards)
+            ],
+            limit,
+        )
+
+    def versions(self) -> Dict[str, str]:
+        return {
+            name: "".join(shard.versions().values())
+            for name, shard in zip(self.names, self.shards)
+        }
+
+    def reload_changed(self) -> List[str]:
+        """Reload the shards whose collection version changed, one at a time."""
+        reloaded = []
+        for name, shard in zip(self.names, self.shards):
+            if shard.reload_changed():
+                reloaded.append(name)
+                logger.info("Reloaded collection %s", name)
+        return reloaded
+
+    def compact(self) -> None:
+        for shard in self.shards:
+            shard.compact()
+
+    def after_fork(self) -> None:
+        # Threads don't survive forking
+        self.pool = ThreadPoolExecutor(
+            max_workers=len(self.shards), thread_name_prefix="shard"
+        )
+        for shard in self.shards:
+            shard.after_fork()
+
+    def load_timings(self) -> Dict[str, float]:
+        timings: Dict[str, float] = defaultdict(float)
+        for shard in self.shards:
+            for stage, seconds in shard.load_timings().items():
+                timings[stage] += seconds
+        return timings
+
+
+def open_song_database() -> SongBackend:
+    """
+    Open the songs: the collections listed in SONG_COLLECTIONS as
+    `name=directory` pairs, or else the songs in the working directory.
+    """
+    collections = {}
+    for entry in os.getenv("SONG_COLLECTIONS", "").split(","):
+        if entry.strip():
+            name, _, directory = entry.partition("=")
+            collections[name.strip().lower()] = directory.strip() or "."
+    if collections:
+        return ShardedSongDatabase(collections)
+    return open_backend()
+
+
+class UnloadedSongs(SongBackend):  # pylint: disable=abstract-method
+    """Stands in for the song database until `load_songs` opens it."""
+
+    def __getattribute__(self, name: str) -> Any:
+        if not name.startswith("_") and callable(getattr(SongBackend, name, None)):
+            raise RuntimeError(
+                f"Songs aren't loaded, call load_songs() before song_db.{name}()"
+            )
+        return super().__getattribute__(name)
+
+
+# Global song database instance, opened at startup by `load_songs` so that
+# importing this module stays fast
+song_db: SongBackend = UnloadedSongs()
+# Seconds spent on each stage of starting up, for the startup report
+startup_timings: Dict[str, float] = {}
+
+
+def truncate_message(text: str, max_length: int = 4000) -> str:
+    """Truncate message if it's too long for Telegram."""
+    if len(text) <= max_length:
+        return text
+
+    # Find a good place to cut (try to cut at a line break)
+    truncated = text[:max_length]
+    last_newline = truncated.rfind("\n")
+
+    if last_newline > max_length - 200:  # If we found a newline close to the limit
+        truncated = truncated[:last_newline]
+
+    return truncated + "\n\n📝 <i>Viesti katkaistiin pituuden vuoksi...</i>"
+
+
+class TokenBucket:
+    """Token bucket that allows `rate` sends per second with bursts of `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Empty the bucket so that the next token is available after `seconds`."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def full(self) -> bool:
+        """Whether the bucket has refilled, so that a new one would be the same."""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+SendFunc = Callable[[], Awaitable["Message"]]
+
+
+@dataclass
+class SendJob:
+    """Messages to one chat that must be sent in order, e.g. chunks of one song."""
+
+    sends: List[SendFunc]
+    future: "asyncio.Future[List[Message]]"
+
+
+class MessageScheduler:
+    """
+    Outgoing message queue with per-chat and global rate limiting.
+
+    Every chat gets its own FIFO queue and worker so that chunks of one song
+    stay in order, while slow chats don't hold back others. Flood control
+    errors from Telegram pause the chat and the send is retried.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        private_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        burst: int = 3,
+        max_queue: int = 20,
+        max_attempts: int = 5,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+
+        self.queues: Dict[int, "asyncio.Queue[SendJob]"] = {}
+        # Buckets outlive the workers so that the limits hold between replies
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.workers: Dict[int, "asyncio.Task[None]"] = {}
+        self.bucket_sweep_interval = 60.0
+        self.last_bucket_sweep = time.monotonic()
+
+        self.sent = 0
+        self.retries = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_env(cls) -> "MessageScheduler":
+        """Create a scheduler using limits from the environment."""
+        return cls(
+            global_rate=float(os.getenv("SEND_GLOBAL_RATE", "30")),
+            private_rate=float(os.getenv("SEND_PRIVATE_RATE", "1")),
+            group_rate=float(os.getenv("SEND_GROUP_RATE", str(20 / 60))),
+            burst=int(os.getenv("SEND_BURST", "3")),
+            max_queue=int(os.getenv("SEND_MAX_QUEUE", "20")),
+        )
+
+    def queue_depth(self) -> int:
+        """Number of jobs waiting to be sent over all chats."""
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for monitoring the outgoing queue."""
+        return {
+            "queue_depth": self.queue_depth(),
+            "active_chats": len(self.workers),
+            "sent": self.sent,
+            "retries": self.retries,
+            "dropped": self.dropped,
+        }
+
+    def submit(
+        self, chat_id: int, sends: List[SendFunc], group: bool = False
+    ) -> "asyncio.Future[List[Message]]":
+        """
+        Queue messages to a chat and return a future for the sent messages.
+
+        If the chat already has too many jobs waiting, the job is dropped and
+        the future is cancelled.
+        """
+        future: "asyncio.Future[List[Message]]" = (
+            asyncio.get_running_loop().create_future()
+        )
+
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue(maxsize=self.max_queue)
+
+        try:
+            queue.put_nowait(SendJob(sends, future))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Send queue for chat %s is full, dropping message", chat_id)
+            future.cancel()
+            return future
+
+        if chat_id not in self.buckets:
+            rate = self.group_rate if group else self.private_rate
+            self.buckets[chat_id] = TokenBucket(rate, self.burst)
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+
+        return future
+
+    async def _worker(self, chat_id: int) -> None:
+        queue = self.queues[chat_id]
+        while not queue.empty():
+            job = queue.get_nowait()
+            try:
+                job.future.set_result(await self._run_job(chat_id, job))
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # The rest of the job is dropped to keep the chat in order
+                self.dropped += 1
+                logger.error("Sending to chat %s failed: %s", chat_id, e)
+                if not job.future.done():
+                    job.future.set_exception(e)
+                    # Nobody necessarily awaits the future, don't warn about it
+                    job.future.exception()
+            finally:
+                queue.task_done()
+
+        # No await between the emptiness check and cleanup, so no job can be lost
+        del self.workers[chat_id]
+        del self.queues[chat_id]
+        self._sweep_buckets()
+
+    def _sweep_buckets(self) -> None:
+        """Forget the buckets of idle chats that have refilled."""
+        now = time.monotonic()
+        if now - self.last_bucket_sweep < self.bucket_sweep_interval:
+            return
+        self.last_bucket_sweep = now
+        for chat_id in [
+            chat_id
+            for chat_id, bucket in self.buckets.items()
+            if chat_id not in self.workers and bucket.full()
+        ]:
+            del self.buckets[chat_id]
+
+    async def _run_job(self, chat_id: int, job: SendJob) -> List[Message]:
+        messages = []
+        for send in job.sends:
+            messages.append(await self._send_with_retry(chat_id, send))
+        return messages
+
+    async def _send_with_retry(self, chat_id: int, send: SendFunc) -> Message:
+        from telegram.error import (  # pylint: disable=import-outside-toplevel
+            NetworkError,
+            RetryAfter,
+            TimedOut,
+        )
+
+        bucket = self.buckets[chat_id]
+        backoff = 1.0
+        for attempt in range(1, self.max_attempts + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                message = await send()
+                self.sent += 1
+                return message
+            except RetryAfter as e:
+                if attempt == self.max_attempts:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(
+                    "Flood control in chat %s, retrying in %s s", chat_id, retry_after
+                )
+                self.retries += 1
+                bucket.pause(retry_after)
+            except (TimedOut, NetworkError) as e:
+                if attempt == self.max_attempts:
+                    raise
+                logger.warning(
+                    "Sending to chat %s failed (%s), retrying in %.0f s",
+                    chat_id,
+                    e,
+                    backoff,
+                )
+                self.retries += 1
+                await asyncio.sleep(backoff)
+                backoff *= 2
+        raise RuntimeError("unreachable")
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """Wait for queued messages to be sent, e.g. before shutting down."""
+        workers = list(self.workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        if pending:
+            logger.warning("Shutting down with %d unsent messages", self.queue_depth())
+
+
+# Global outgoing message scheduler
+message_scheduler = MessageScheduler.from_env()
+
+
+def split_message(text: str, max_length: int = 4000) -> List[str]:
+    """Split text into chunks that fit in a Telegram message."""
+    chunks = []
+    remaining = text
+
+    while len(remaining) > max_length:
+        # Find a good place to split (prefer line breaks)
+        chunk = remaining[:max_length]
+        last_newline = chunk.rfind("\n\n")  # Look for paragraph breaks first
+        if last_newline == -1:
+            last_newline = chunk.rfind("\n")  # Then any line break
+
+        if last_newline > max_length - 200:  # If we found a good break point
+            split_point = last_newline
+        else:
+            split_point = max_length
+
+        chunks.append(remaining[:split_point])
+        remaining = remaining[split_point:].lstrip()
+
+    if remaining:
+        chunks.append(remaining)
+
+    return chunks
+
+
+def send_long_message(
+    update: Update,
+    text: str,
+    parse_mode: str = "HTML",
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> "asyncio.Future[List[Message]]":
+    """
+    Queue a message for sending, splitting it if it's too long.
+
+    Returns a future resolving to the sent messages.
+    """
+    max_length = 4000  # Leave some buffer under Telegram's 4096 limit
+
+    return send_chunks(
+        update, split_message(text, max_length), parse_mode, reply_markup
+    )
+
+
+def pack_messages(texts: List[str], max_length: int = 4000) -> List[str]:
+    """
+    Pack texts in order into as few messages as fit, splitting texts that
+    don't fit in one message like `split_message`.
+    """
+    messages: List[str] = []
+    current = ""
+    for text in texts:
+        if current and len(current) + 2 + len(text) <= max_length:
+            current += "\n\n" + text
+            continue
+        if current:
+            messages.append(current)
+        *full, current = split_message(text, max_length) or [""]
+        messages.extend(full)
+    if current:
+        messages.append(current)
+    return messages
+
+
+def send_chunks(
+    update: Update,
+    chunks: List[str],
+    parse_mode: str = "HTML",
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> "asyncio.Future[List[Message]]":
+    """
+    Queue messages for sending in order, the first as a reply and the buttons
+    under the last. Returns a future resolving to the sent messages.
+    """
+
+    def reply(chunk: str, markup: Optional[InlineKeyboardMarkup]) -> SendFunc:
+        # First chunk - send as reply
+        return lambda: update.effective_message.reply_text(
+            chunk,
+            parse_mode=parse_mode,
+            disable_web_page_preview=True,
+            reply_markup=markup,
+        )
+
+    def follow_up(chunk: str, markup: Optional[InlineKeyboardMarkup]) -> SendFunc:
+        # Subsequent chunks - send as follow-up
+        return lambda: update.effective_chat.send_message(
+            chunk,
+            parse_mode=parse_mode,
+            disable_web_page_preview=True,
+            reply_markup=markup,
+        )
+
+    # Buttons go under the last chunk
+    markups = [None] * (len(chunks) - 1) + [reply_markup]
+    sends = [reply(chunks[0], markups[0])] + [
+        follow_up(chunk, markup) for chunk, markup in zip(chunks[1:], markups[1:])
+    ]
+
+    chat = update.effective_chat
+    return message_scheduler.submit(chat.id, sends, group=chat.type != "private")
+
+
+class SingleFlight:
+    """Share one computation between concurrent callers with the same key."""
+
+    def __init__(self):
+        self.in_flight: Dict[str, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: str, func: Callable[[], Any]) -> Any:
+        """Run `func` in a thread, or wait for the run already in flight for `key`."""
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(asyncio.to_thread(func))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shield so that one cancelled caller doesn't cancel the others
+        return await asyncio.shield(future)
+
+
+class RecentReplies:
+    """
+    Remember replies sent to each chat for a short dedup window. A reply is
+    recorded while it's still being searched for, as a future that gets the
+    future of the sent messages once the reply is queued.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.replies: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self.replies:
+            _, (sent_at, _) = next(iter(self.replies.items()))
+            if now - sent_at < self.window:
+                break
+            self.replies.popitem(last=False)
+
+    def add(
+        self,
+        chat_id: int,
+        key: str,
+        future: "asyncio.Future[asyncio.Future[List[Message]]]",
+    ) -> None:
+        """Record the reply being made to a query, before searching for it."""
+        if self.window <= 0:
+            return
+        self._expire()
+        self.replies[(chat_id, key)] = (time.monotonic(), future)
+        self.replies.move_to_end((chat_id, key))
+
+    def get(
+        self, chat_id: int, key: str
+    ) -> Optional["asyncio.Future[asyncio.Future[List[Message]]]"]:
+        """Return the reply made to the query within the window, if any."""
+        if self.window <= 0:
+            return None
+        self._expire()
+        entry = self.replies.get((chat_id, key))
+        if entry is None or entry[1].cancelled():
+            return None
+        return entry[1]
+
+
+# Concurrent identical searches and repeated requests in a chat
+search_flight = SingleFlight()
+recent_replies = RecentReplies(float(os.getenv("DEDUP_WINDOW_SECONDS", "0")))
+
+
+class ResultSetStore:
+    """Short-lived search results that inline buttons refer to by a token."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self.entries:
+            _, (expires_at, _, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+
+    def put(self, query: str, hits: List[SearchHit]) -> str:
+        """Store a result set and return the token that refers to it."""
+        token = secrets.token_urlsafe(6)
+        self.entries[token] = (time.monotonic() + self.ttl, query, hits)
+        self._expire()
+        return token
+
+    def get(self, token: str) -> Optional[Tuple[str, List[SearchHit]]]:
+        """Return the query and results for a token, or None if expired."""
+        self._expire()
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        _, query, hits = entry
+        return query, hits
+
+
+# Results behind the inline buttons of multi-result replies
+RESULTS_PER_PAGE = 5
+MAX_STORED_RESULTS = 50
+result_store = ResultSetStore(
+    ttl=float(os.getenv("RESULT_TTL_SECONDS", "900")),
+    max_size=int(os.getenv("RESULT_STORE_SIZE", "1000")),
+)
+
+
+class PopularityTracker:
+    """
+    Counts song views and search queries in memory, and adds the new counts
+    to an SQLite file now and then.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        # Empty path keeps the counts in memory only
+        self.path = path
+        self.flush_interval = flush_interval
+        self.views: Counter = Counter()
+        self.queries: Counter = Counter()
+        # Counts not yet written to the file
+        self.new_views: Counter = Counter()
+        self.new_queries: Counter = Counter()
+        # Whether there are views the song database hasn't been given yet
+        self.views_changed = False
+        self.flusher: Optional["asyncio.Task[None]"] = None
+        # Where worker processes send their new counts instead of writing
+        # them, so that the process that forked them is the file's one writer
+        self.forward_to: Optional["multiprocessing.Queue[Any]"] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS song_views "
+            "(song TEXT PRIMARY KEY, views INTEGER NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS queries "
+            "(query TEXT PRIMARY KEY, count INTEGER NOT NULL)"
+        )
+        return connection
+
+    def load(self) -> None:
+        """Read the counts saved by earlier runs."""
+        if not self.path:
+            return
+        try:
+            connection = self._connect()
+            with connection:
+                self.views.update(
+                    dict(connection.execute("SELECT song, views FROM song_views"))
+                )
+                self.queries.update(
+                    dict(connection.execute("SELECT query, count FROM queries"))
+                )
+            connection.close()
+        except sqlite3.Error as e:
+            logger.error("Error reading popularity from %s: %s", self.path, e)
+        logger.info(
+            "Loaded views of %d songs and %d queries",
+            len(self.views),
+            len(self.queries),
+        )
+
+    def record_view(self, song: Dict[str, Any]) -> None:
+        """Count a song being shown in full."""
+        name = song.get("name", "")
+        self.views[name] += 1
+        self.new_views[name] += 1
+        self.views_changed = True
+
+    def record_query(self, key: str) -> None:
+        """Count a normalized search query."""
+        self.queries[key] += 1
+        self.new_queries[key] += 1
+
+    def add(self, views: Counter, queries: Counter) -> None:
+        """Count the views and queries forwarded by a worker process."""
+        self.views.update(views)
+        self.new_views.update(views)
+        self.queries.update(queries)
+        self.new_queries.update(queries)
+        self.views_changed = self.views_changed or bool(views)
+
+    def _write(self, views: Counter, queries: Counter) -> None:
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT INTO song_views VALUES (?, ?) ON CONFLICT(song) "
+                "DO UPDATE SET views = views + excluded.views",
+                views.items(),
+            )
+            connection.executemany(
+                "INSERT INTO queries VALUES (?, ?) ON CONFLICT(query) "
+                "DO UPDATE SET count = count + excluded.count",
+                queries.items(),
+            )
+        connection.close()
+
+    async def flush(self) -> None:
+        """Write the new counts in a thread, keeping them if that fails."""
+        if not (self.path or self.forward_to) or not (
+            self.new_views or self.new_queries
+        ):
+            return
+        views, self.new_views = self.new_views, Counter()
+        queries, self.new_queries = self.new_queries, Counter()
+        if self.forward_to is not None:
+            await asyncio.to_thread(self.forward_to.put, (views, queries))
+            return
+        try:
+            await asyncio.to_thread(self._write, views, queries)
+        except sqlite3.Error as e:
+            logger.error("Error saving popularity to %s: %s", self.path, e)
+            self.new_views.update(views)
+            self.new_queries.update(queries)
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            # Let the new views break ties in search results, reordering in a
+            # thread as it redoes the completions. Workers keep the order they
+            # were forked with, which would stop being shared if changed
+            if self.views_changed and self.forward_to is None:
+                self.views_changed = False
+                await asyncio.to_thread(song_db.set_popularity, dict(self.views))
+
+    def forward(self, counts: "multiprocessing.Queue[Any]") -> None:
+        """
+        Send the new counts to `counts` instead of writing them, in a worker
+        forked from the process that writes them.
+        """
+        self.forward_to = counts
+        # Counted before forking, so the writing process has these already
+        self.new_views = Counter()
+        self.new_queries = Counter()
+        self.views_changed = False
+        self.flusher = None
+
+    def start(self) -> None:
+        """Start flushing the counts in the background."""
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        """Stop the background flushes and write what's left."""
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+
+
+popularity = PopularityTracker(
+    os.getenv("POPULARITY_DB", "popularity.sqlite3"),
+    flush_interval=float(os.getenv("POPULARITY_FLUSH_SECONDS", "60")),
+)
+# Most viewed songs rendered at startup, before answering updates unless
+# rendered in the background
+WARM_SONGS = int(os.getenv("WARM_SONGS", "20"))
+WARM_IN_BACKGROUND = os.getenv("WARM_IN_BACKGROUND", "0") == "1"
+
+# How often collection versions are checked for reloading, 0 for never
+COLLECTION_CHECK_SECONDS = float(os.getenv("COLLECTION_CHECK_SECONDS", "60"))
+# Tasks running for as long as the bot does
+background_tasks: List["asyncio.Task[None]"] = []
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records rather than wait for a full queue."""
+
+    def __init__(self, records: "Queue[Optional[logging.LogRecord]]"):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener thread formats the record, not the event loop
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class BlockingStopQueueListener(logging.handlers.QueueListener):
+    """Queue listener that waits for room for its stop sentinel."""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats the `event` of a record as one line of JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = {"time": round(record.created, 3), **getattr(record, "event", {})}
+        return json.dumps(event, ensure_ascii=False)
+
+
+class QueryLog:
+    """
+    A sample of search events written as JSON Lines to a rotating file.
+
+    Events are only put on a bounded queue in the event loop, a background
+    thread writes them, and events that don't fit in the queue are dropped.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample: float = 1.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backups: int = 5,
+        queue_size: int = 10000,
+    ):
+        self.path = path
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.logger = logging.getLogger(f"{__name__}.queries")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler: Optional[DroppingQueueHandler] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        """Open the file and start the writer thread, if logging is enabled."""
+        if not self.path or self.sample <= 0 or self.listener is not None:
+            return
+        writer = logging.handlers.RotatingFileHandler(
+            self.path,
+            maxBytes=self.max_bytes,
+            backupCount=self.backups,
+            encoding="utf-8",
+            delay=True,
+        )
+        writer.setFormatter(JsonLinesFormatter())
+        records: "Queue[Optional[logging.LogRecord]]" = Queue(self.queue_size)
+        self.handler = DroppingQueueHandler(records)
+        self.listener = BlockingStopQueueListener(records, writer)
+        self.listener.start()
+        self.logger.addHandler(self.handler)
+        logger.info("Logging %g of queries to %s", self.sample, self.path)
+
+    def log(
+        self,
+        query: str,
+        hits: List[SearchHit],
+        seconds: float,
+        chat_type: str,
+        suggestions: Optional[List[SearchHit]] = None,
+    ) -> None:
+        """
+        Log a search, unless it's left out of the sample. `suggestions` are
+        the songs offered instead when it found nothing.
+        """
+        if self.handler is None or random.random() >= self.sample:
+            return
+        event = {
+            "query": query,
+            "results": [hit.song.get("id") for hit in hits],
+            "count": len(hits),
+            "suggested": [hit.song.get("id") for hit in suggestions or ()],
+            "ms": round(seconds * 1000, 2),
+            "chat_type": chat_type,
+        }
+        self.logger.info("query", extra={"event": event})
+
+    def stop(self) -> None:
+        """Write the queued events and close the file."""
+        if self.listener is None or self.handler is None:
+            return
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+        for writer in self.listener.handlers:
+            writer.close()
+        if self.handler.dropped:
+            logger.warning("Dropped %d queued query events", self.handler.dropped)
+        self.handler = None
+        self.listener = None
+
+
+# JSON Lines file of search events, empty to not log them, and the share
+# of searches logged
+query_log = QueryLog(
+    os.getenv("QUERY_LOG", ""),
+    sample=float(os.getenv("QUERY_LOG_SAMPLE", "1")),
+    max_bytes=int(os.getenv("QUERY_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backups=int(os.getenv("QUERY_LOG_BACKUPS", "5")),
+)
+
+
+async def reload_collections() -> List[str]:
+    """
+    Reload the collections whose version changed, then compact the indexes.
+    Returns the names of the reloaded collections.
+    """
+    reloaded = await asyncio.to_thread(song_db.reload_changed)
+    if reloaded:
+        logger.info("Reloaded %s, compacting", ", ".join(reloaded))
+        await asyncio.to_thread(song_db.compact)
+    return reloaded
+
+
+# Unix socket where `extract_songs.py --notify` asks for a reload, empty for none
+RELOAD_SOCKET = os.getenv("RELOAD_SOCKET", "")
+
+
+async def serve_reload_socket(
+    path: str, reload: Callable[[], Awaitable[List[str]]]
+) -> None:
+    """Run `reload` for each line sent to a Unix socket, answering what it did."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readline()
+            done = await reload()
+            writer.write(f"reloaded {', '.join(done) or 'nothing'}\n".encode())
+            await writer.drain()
+        finally:
+            writer.close()
+
+    # A socket file left behind by an earlier run would make binding fail
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path)
+    logger.info("Listening for reload requests on %s", path)
+    async with server:
+        await server.serve_forever()
+
+
+async def watch_collections(
+    reload: Callable[[], Awaitable[List[str]]] = reload_collections,
+) -> None:
+    """Reload the collections whose version changed, checking now and then."""
+    while True:
+        await asyncio.sleep(COLLECTION_CHECK_SECONDS)
+        await reload()
+
+
+# How long Telegram may cache the answer to an inline query
+INLINE_CACHE_SECONDS = int(os.getenv("INLINE_CACHE_SECONDS", "300"))
+
+
+def send_pointer_to_earlier(
+    update: Update, earlier: "asyncio.Future[List[Message]]"
+) -> None:
+    """Reply to an earlier answer to the same query instead of resending it."""
+    from telegram import ReplyParameters  # pylint: disable=import-outside-toplevel
+
+    async def send() -> Message:
+        # The earlier reply was queued first in the same chat, so it's sent by now
+        messages = await earlier
+        return await update.effective_chat.send_message(
+            "☝️ Tähän hakuun vastattiin juuri, katso yllä!",
+            reply_parameters=ReplyParameters(
+                message_id=messages[0].message_id, allow_sending_without_reply=True
+            ),
+        )
+
+    chat = update.effective_chat
+    message_scheduler.submit(chat.id, [send], group=chat.type != "private")
+
+
+async def fiisu_command_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Handle /fiisu command."""
+    # Get the search query from command arguments
+    query = " ".join(context.args) if context.args else ""
+    logger.debug("Received /fiisu command with query: %s", query)
+
+    if not query.strip():
+        # Check if we're in a private chat to show different help
+        chat_type = update.effective_chat.type
+        if chat_type == "private":
+            help_text = (
+                "🎵 Käyttö: /fiisu hakusana\n\n"
+                "Esimerkki: /fiisu teemu\n"
+                "Voit myös kirjoittaa hakusanan suoraan ilman komentoa!\n\n"
+                "Hae Fiisuja nimellä tai sanoilla!"
+            )
+        else:
+            help_text = (
+                "🎵 Käyttö: /fiisu hakusana\n\n"
+                "Esimerkki: /fiisu teemu\n\n"
+                "Hae Fiisuja nimellä tai sanoilla!"
+            )
+
+        send_long_message(update, help_text)
+        return
+
+    key = normalize_query(query)
+    chat_id = update.effective_chat.id
+
+    # Someone just asked for the same thing in this chat, point to that reply
+    # once it's queued, unless it failed
+    earlier = recent_replies.get(chat_id, key)
+    if earlier is not None:
+        await asyncio.wait([earlier])
+        if not earlier.cancelled():
+            send_pointer_to_earlier(update, earlier.result())
+            return
+
+    # Recorded before searching, so that the same request arriving meanwhile
+    # points to this reply instead of sending it again
+    reply: "asyncio.Future[asyncio.Future[List[Message]]]" = (
+        asyncio.get_running_loop().create_future()
+    )
+    recent_replies.add(chat_id, key, reply)
+    try:
+        await reply_to_search(update, query, key, reply)
+    finally:
+        if not reply.done():
+            reply.cancel()
+
+
+async def reply_to_search(
+    update: Update,
+    query: str,
+    key: str,
+    reply: "asyncio.Future[asyncio.Future[List[Message]]]",
+) -> None:
+    """Search for a /fiisu query and queue the reply, setting it to `reply`."""
+    popularity.record_query(key)
+
+    # Concurrent identical queries share one search and render
+    started = time.perf_counter()
+    hits, message_text, full_song, suggested = await search_flight.do(
+        key, lambda: search_and_render(query)
+    )
+    query_log.log(
+        key,
+        [] if suggested else hits,
+        time.perf_counter() - started,
+        update.effective_chat.type,
+        suggestions=hits if suggested else None,
+    )
+
+    reply_markup = None
+    if full_song:
+        popularity.record_view(hits[0].song)
+        reply_markup = related_songs_keyboard(hits[0].index)
+    elif hits:
+        # Keep the results so that the buttons never have to search again
+        token = result_store.put(query, hits)
+        reply_markup = result_page_keyboard(token, len(hits), 0)
+
+    reply.set_result(send_long_message(update, message_text, reply_markup=reply_markup))
+
+
+def search_and_render(query: str) -> Tuple[List[SearchHit], str, bool, bool]:
+    """
+    Search for songs and format the reply message for the first page.
+
+    Returns the listed songs, the message, whether it's a single full song
+    and whether the songs are suggestions for a search that found nothing.
+    """
+    # Search for songs
+    hits = song_db.search_hits(query, limit=MAX_STORED_RESULTS)
+
+    if not hits:
+        no_results = f"🔍 Ei tuloksia haulle: <b>{escape_html(query)}</b>\n\n"
+
+        # Maybe the name or first line was misremembered
+        suggestions = song_db.suggest(query)
+        if suggestions:
+            header = no_results + "🤔 <b>Tarkoititko jotain näistä?</b>\n\n"
+            page = render_result_page(query, suggestions, 0, header)
+            return suggestions, page, False, True
+
+        return hits, no_results + "Kokeile eri hakusanoja!", False, False
+
+    # If only one result, send the full song
+    if len(hits) == 1:
+        return hits, render_hit(hits[0]), True, False
+
+    return hits, render_result_page(query, hits, 0), False, False
+
+
+# Most songs one /setlist sends
+SETLIST_MAX_SONGS = int(os.getenv("SETLIST_MAX_SONGS", "30"))
+# Numbering or bullets in front of the titles of a pasted setlist
+SETLIST_MARKER = re.compile(r"^\s*(?:\d+\s*[.):]|[-•*–])\s*")
+
+
+def parse_setlist(text: str) -> List[str]:
+    """
+    Song titles of a setlist: one per line, or separated by commas or
+    semicolons when the setlist is on one line.
+    """
+    lines = [line for line in text.split("\n") if line.strip()]
+    if len(lines) == 1:
+        lines = re.split(r"[,;]", lines[0])
+    titles = [SETLIST_MARKER.sub("", line).strip() for line in lines]
+    return [title for title in titles if title]
+
+
+def render_setlist(titles: List[str]) -> Tuple[List[SearchHit], List[str]]:
+    """
+    Look up all titles of a setlist at once and render the songs found,
+    packed into as few messages as fit. Returns the songs and the messages.
+    """
+    found = song_db.find_titles(titles)
+    hits = [hit for hit in found if hit is not None]
+    missing = [title for title, hit in zip(titles, found) if hit is None]
+
+    texts = [f"🎶 <b>Setlista</b>: {len(hits)}/{len(titles)} laulua löytyi"]
+    texts += [render_song_at(hit.index) for hit in hits]
+    if missing:
+        texts.append(
+            "❓ <b>Ei löytynyt:</b>\n"
+            + "\n".join(f"• {escape_html(title)}" for title in missing)
+        )
+    return hits, pack_messages(texts)
+
+
+async def setlist_command_handler(
+    update: Update, _context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Handle /setlist: send many songs, one title per line, in few messages."""
+    # The titles are on the lines after the command, which args would join
+    command, _, text = update.effective_message.text.partition("\n")
+    titles = parse_setlist(" ".join(command.split()[1:]) + "\n" + text)
+    logger.info("Received /setlist with %d titles", len(titles))
+
+    if not titles:
+        send_long_message(
+            update,
+            "🎶 Käyttö: /setlist ja laulujen nimet omille riveilleen, esim.\n\n"
+            "/setlist\nTeemu\nJuomalaulu\nPolyteknikkojen marssi",
+        )
+        return
+    if len(titles) > SETLIST_MAX_SONGS:
+        send_long_message(
+            update,
+            f"🎶 Setlistassa voi olla enintään {SETLIST_MAX_SONGS} laulua, "
+            f"nyt niitä oli {len(titles)}.",
+        )
+        return
+
+    hits, messages = await asyncio.to_thread(render_setlist, titles)
+    for hit in hits:
+        popularity.record_view(hit.song)
+    # One queued job, paced by the send limits of the chat
+    send_chunks(update, messages)
+
+
+def mark_lyrics_line(lyrics: str, verse: int, line: int) -> str:
+    """Point out a line of the lyrics, given its verse and line number."""
+    verses = VERSE_BREAK.split(lyrics.strip())
+    if verse > len(verses):
+        return lyrics
+    lines = verses[verse - 1].split("\n")
+    if line > len(lines):
+        return lyrics
+    lines[line - 1] = "👉 " + lines[line - 1]
+    verses[verse - 1] = "\n".join(lines)
+    return "\n\n".join(verses) + lyrics[len(lyrics.rstrip()) :]
+
+
+def render_song(song: Dict[str, Any], hit: Optional[SearchHit] = None) -> str:
+    """Format a full song with its metadata, pointing out where a search hit."""
+    name = song.get("name", "Unknown Song")
+    lyrics = song.get("lyrics", "No lyrics available")
+    melody = song.get("melody")
+    composer = song.get("composer")
+    arranger = song.get("arranger")
+    notes = song.get("notes")
+    collection = song.get("collection")
 
-    if last_newline > max_length - 200:  # If we found a newline close to the limit
-        truncated = truncated[:last_newline]
+    # Build the message with metadata
+    message_text = f"🎵 <b>{name}</b>\n"
 
-    return truncated + "\n\n📝 <i>Viesti katkaistiin pituuden vuoksi...</i>"
+    # Add metadata if available
+    metadata_parts = []
+    if melody:
+        metadata_parts.append(f"🎼 Sävel: {melody}")
+    if composer:
+        metadata_parts.append(f"✍️ Säveltäjä: {composer}")
+    if arranger:
+        metadata_parts.append(f"🎹 Sovittaja: {arranger}")
+    if collection:
+        metadata_parts.append(f"📚 Kokoelma: {collection}")
 
+    if metadata_parts:
+        message_text += "\n" + "\n".join(metadata_parts) + "\n"
 
-async def send_long_message(
-    update: Update, text: str, parse_mode=ParseMode.HTML
-) -> None:
-    """Send a message, splitting it if it's too long."""
-    max_length = 4000  # Leave some buffer under Telegram's 4096 limit
+    # Point out the matching line if the search matched the lyrics
+    if hit is not None and hit.verse is not None and hit.line is not None:
+        message_text += f"\n📍 Osuma: {hit.verse}. säkeistö, {hit.line}. rivi\n"
+        lyrics = mark_lyrics_line(lyrics, hit.verse, hit.line)
 
-    if len(text) <= max_length:
-        await update.message.reply_text(
-            text, parse_mode=parse_mode, disable_web_page_preview=True
-        )
-        return
+    message_text += f"\n{lyrics}"
 
-    # Split into chunks
-    chunks = []
-    remaining = text
+    # Add notes if available
+    if notes:
+        message_text += f"\n\n📝 {notes}"
 
-    while len(remaining) > max_length:
-        # Find a good place to split (prefer line breaks)
-        chunk = remaining[:max_length]
-        last_newline = chunk.rfind("\n\n")  # Look for paragraph breaks first
-        if last_newline == -1:
-            last_newline = chunk.rfind("\n")  # Then any line break
+    return message_text
 
-        if last_newline > max_length - 200:  # If we found a good break point
-            split_point = last_newline
-        else:
-            split_point = max_length
 
-        chunks.append(remaining[:split_point])
-        remaining = remaining[split_point:].lstrip()
+@lru_cache(maxsize=int(os.getenv("RENDER_CACHE_SIZE", "256")))
+def render_song_version(idx: int, _version: str) -> str:
+    """Render a song, cached for as long as its content stays the same."""
+    return render_song(song_db.song(idx))
 
-    if remaining:
-        chunks.append(remaining)
 
-    # Send each chunk
-    for i, chunk in enumerate(chunks):
-        if i == 0:
-            # First chunk - send as reply
-            await update.message.reply_text(
-                chunk, parse_mode=parse_mode, disable_web_page_preview=True
-            )
-        else:
-            # Subsequent chunks - send as follow-up
-            await update.effective_chat.send_message(
-                chunk, parse_mode=parse_mode, disable_web_page_preview=True
-            )
+def render_song_at(idx: int) -> str:
+    """Full song without a search hit to point out, from the render cache."""
+    return render_song_version(idx, song_db.version_of(idx))
 
 
-async def fiisu_command_handler(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
-) -> None:
-    """Handle /fiisu command."""
-    # Get the search query from command arguments
-    query = " ".join(context.args) if context.args else ""
-    logger.info("Received /fiisu command with query: %s", query)
+def hit_song(hit: SearchHit) -> Dict[str, Any]:
+    """The song of a search hit with its lyrics, decompressed if need be."""
+    if "lyrics" in hit.song:
+        return hit.song
+    return song_db.song(hit.index)
 
-    if not query.strip():
-        # Check if we're in a private chat to show different help
-        chat_type = update.effective_chat.type
-        if chat_type == "private":
-            help_text = (
-                "🎵 Käyttö: /fiisu hakusana\n\n"
-                "Esimerkki: /fiisu teemu\n"
-                "Voit myös kirjoittaa hakusanan suoraan ilman komentoa!\n\n"
-                "Hae Fiisuja nimellä tai sanoilla!"
-            )
-        else:
-            help_text = (
-                "🎵 Käyttö: /fiisu hakusana\n\n"
-                "Esimerkki: /fiisu teemu\n\n"
-                "Hae Fiisuja nimellä tai sanoilla!"
-            )
 
-        await update.message.reply_text(
-            help_text,
-            parse_mode=ParseMode.HTML,
-        )
-        return
+def render_hit(hit: SearchHit) -> str:
+    """Full song of a search hit, from the cache if the lyrics didn't match."""
+    if hit.verse is None or hit.line is None:
+        return render_song_at(hit.index)
+    return render_song(hit_song(hit), hit)
 
-    # Search for songs
-    matching_songs = song_db.search(query, limit=5)
 
-    if not matching_songs:
-        await update.message.reply_text(
-            f"🔍 Ei tuloksia haulle: <b>{escape_html(query)}</b>\n\n"
-            "Kokeile eri hakusanoja!",
-            parse_mode=ParseMode.HTML,
-        )
-        return
+def render_result_page(
+    query: str, hits: List[SearchHit], page: int, header: Optional[str] = None
+) -> str:
+    """Format one page of search results with the first line of each song."""
+    if header is None:
+        header = f"🎵 <b>Löytyi {len(hits)} laulua haulle:</b> {escape_html(query)}\n\n"
+    message_text = header
 
-    # Format and send results
-    if len(matching_songs) == 1:
-        # If only one result, send the full song
-        song = matching_songs[0]
+    terms = query_terms(query)
+    start = page * RESULTS_PER_PAGE
+    for i, hit in enumerate(hits[start : start + RESULTS_PER_PAGE], start + 1):
+        song = hit_song(hit)
         name = song.get("name", "Unknown Song")
-        lyrics = song.get("lyrics", "No lyrics available")
+        lyrics = song.get("lyrics", "")
         melody = song.get("melody")
         composer = song.get("composer")
-        arranger = song.get("arranger")
-        notes = song.get("notes")
 
-        # Build the message with metadata
-        message_text = f"🎵 <b>{name}</b>\n"
-
-        # Add metadata if available
-        metadata_parts = []
+        # Build metadata preview
+        metadata_preview = []
         if melody:
-            metadata_parts.append(f"🎼 Sävel: {melody}")
+            metadata_preview.append(f"sävel: {melody}")
         if composer:
-            metadata_parts.append(f"✍️ Säveltäjä: {composer}")
-        if arranger:
-            metadata_parts.append(f"🎹 Sovittaja: {arranger}")
+            metadata_preview.append(f"säv: {composer}")
+        if song.get("collection"):
+            metadata_preview.append(f"kokoelma: {song['collection']}")
 
-        if metadata_parts:
-            message_text += "\n" + "\n".join(metadata_parts) + "\n"
+        # Show where the lyrics matched, or the first line as preview
+        lyrics_preview = song_db.snippet(hit, terms)
+        if lyrics_preview is None:
+            lyrics_preview = lyrics.split("\n")[0] if lyrics else "Ei saatavilla"
+            if len(lyrics_preview) > 40:
+                lyrics_preview = lyrics_preview[:40] + "..."
+
+        # Escape HTML in name and previews
+        message_text += f"{i}. <b>{name}</b>\n"
 
-        message_text += f"\n{lyrics}"
+        # Add metadata if available
+        if metadata_preview:
+            escaped_metadata = " | ".join(metadata_preview)
+            message_text += f"   📄 <i>{escaped_metadata}</i>\n"
 
-        # Add notes if available
-        if notes:
-            message_text += f"\n\n📝 {notes}"
+        message_text += f"   🎵 <i>{lyrics_preview}</i>\n\n"
 
-        await send_long_message(update, message_text)
-    else:
-        # If multiple results, show a list with first few lines of each
-        message_text = (
-            f"🎵 <b>Löytyi {len(matching_songs)} laulua haulle:</b> "
-            f"{escape_html(query)}\n\n"
+    message_text += "💡 Valitse laulu napista tai tarkenna hakua!"
+
+    return message_text
+
+
+def result_page_keyboard(token: str, total: int, page: int) -> InlineKeyboardMarkup:
+    """Buttons for opening the songs on a result page and moving between pages."""
+    from telegram import (  # pylint: disable=import-outside-toplevel
+        InlineKeyboardButton,
+        InlineKeyboardMarkup,
+    )
+
+    start = page * RESULTS_PER_PAGE
+    end = min(start + RESULTS_PER_PAGE, total)
+    song_buttons = [
+        InlineKeyboardButton(str(i + 1), callback_data=f"fiisu:{token}:s:{i}")
+        for i in range(start, end)
+    ]
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(
+            InlineKeyboardButton("◀️", callback_data=f"fiisu:{token}:p:{page - 1}")
+        )
+    if end < total:
+        nav_buttons.append(
+            InlineKeyboardButton("▶️", callback_data=f"fiisu:{token}:p:{page + 1}")
         )
 
-        for i, song in enumerate(matching_songs, 1):
-            name = song.get("name", "Unknown Song")
-            lyrics = song.get("lyrics", "")
-            melody = song.get("melody")
-            composer = song.get("composer")
+    return InlineKeyboardMarkup([song_buttons, nav_buttons])
 
-            # Build metadata preview
-            metadata_preview = []
-            if melody:
-                metadata_preview.append(f"sävel: {melody}")
-            if composer:
-                metadata_preview.append(f"säv: {composer}")
 
-            # Show first line or two of lyrics as preview
-            lyrics_preview = lyrics.split("\n")[0] if lyrics else "Ei saatavilla"
-            if len(lyrics_preview) > 40:
-                lyrics_preview = lyrics_preview[:40] + "..."
+def related_songs_keyboard(index: int) -> Optional[InlineKeyboardMarkup]:
+    """Button for listing the songs similar to a song, if there are any."""
+    from telegram import (  # pylint: disable=import-outside-toplevel
+        InlineKeyboardButton,
+        InlineKeyboardMarkup,
+    )
+
+    # The button refers to the song by its key, which survives reloads
+    callback_data = f"fiisu:-:r:{song_db.key_of(index)}"
+    if not song_db.related(index) or len(callback_data.encode("utf-8")) > 64:
+        return None
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "🎶 Samankaltaisia lauluja", callback_data=callback_data
+                )
+            ]
+        ]
+    )
+
+
+def send_related_songs(update: Update, index: int) -> None:
+    """List the songs similar to a song, with buttons for opening them."""
+    hits = song_db.related(index)
+    if not hits:
+        return
+
+    name = song_db.song(index).get("name", "Unknown Song")
+    header = f"🎶 <b>Samankaltaisia lauluja kuin</b> {escape_html(name)}\n\n"
+    token = result_store.put(name, hits)
+    send_long_message(
+        update,
+        render_result_page(name, hits, 0, header),
+        reply_markup=result_page_keyboard(token, len(hits), 0),
+    )
+
 
-            # Escape HTML in name and previews
-            message_text += f"{i}. <b>{name}</b>\n"
+async def handle_result_button(
+    update: Update, _context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Handle result list buttons: open a song or move to another page."""
+    callback_query = update.callback_query
+    try:
+        _, token, action, value = callback_query.data.split(":", 3)
+        # Related song buttons refer to the song by its key
+        index = song_db.find(value) if action == "r" else int(value)
+    except ValueError:
+        await callback_query.answer()
+        return
 
-            # Add metadata if available
-            if metadata_preview:
-                escaped_metadata = " | ".join(metadata_preview)
-                message_text += f"   📄 <i>{escaped_metadata}</i>\n"
+    # Related songs are precomputed, so these buttons only expire with the song
+    if action == "r":
+        await callback_query.answer()
+        if index is not None:
+            send_related_songs(update, index)
+        return
 
-            message_text += f"   🎵 <i>{lyrics_preview}</i>\n\n"
+    entry = result_store.get(token)
+    if entry is None:
+        await callback_query.answer(
+            "Haku on vanhentunut, hae uudelleen!", show_alert=True
+        )
+        return
 
-        message_text += "💡 Tarkenna hakua saadaksesi koko laulun!"
+    query, hits = entry
+    await callback_query.answer()
 
-        await send_long_message(update, message_text)
+    if action == "s" and 0 <= index < len(hits):
+        popularity.record_view(hits[index].song)
+        send_long_message(
+            update,
+            render_hit(hits[index]),
+            reply_markup=related_songs_keyboard(hits[index].index),
+        )
+    elif action == "p" and 0 <= index * RESULTS_PER_PAGE < len(hits):
+        text = render_result_page(query, hits, index)
+        markup = result_page_keyboard(token, len(hits), index)
+        chat = update.effective_chat
+        message_scheduler.submit(
+            chat.id,
+            [
+                lambda: callback_query.edit_message_text(
+                    text,
+                    parse_mode="HTML",
+                    reply_markup=markup,
+                    disable_web_page_preview=True,
+                )
+            ],
+            group=chat.type != "private",
+        )
 
 
 async def send_help_message(
@@ -293,8 +3324,12 @@ async def send_help_message(
             "<b>Esimerkkejä:</b>\n"
             "• /fiisu teemu\n"
             "• /fiisu juomalaulu\n"
-            "• /fiisu polyteknikko\n\n"
-            f"📚 Tietokannassa on {len(song_db.songs)} laulua Fiisut-V kokoelmasta.\n\n"
+            "• /fiisu polyteknikko\n"
+            "• /fiisu sävel: helan går\n\n"
+            "🎶 Monta laulua kerralla: /setlist ja nimet omille riveilleen\n\n"
+            "<b>Tarkennukset:</b> nimi:, sävel:, säv:, sov:, sanat: "
+            'sekä "lainausmerkit" tarkalle fraasille ja "sanat lähekkäin"~3\n\n'
+            f"📚 Tietokannassa on {song_db.song_count()} laulua Fiisut-V kokoelmasta.\n\n"
             "🇬🇧 For English instructions, use /english"
         )
     else:
@@ -305,14 +3340,16 @@ async def send_help_message(
             "<b>Esimerkkejä:</b>\n"
             "• /fiisu teemu\n"
             "• /fiisu juomalaulu\n"
-            "• /fiisu polyteknikko\n\n"
-            f"📚 Tietokannassa on {len(song_db.songs)} laulua Fiisut-V kokoelmasta.\n\n"
+            "• /fiisu polyteknikko\n"
+            "• /fiisu sävel: helan går\n\n"
+            "🎶 Monta laulua kerralla: /setlist ja nimet omille riveilleen\n\n"
+            "<b>Tarkennukset:</b> nimi:, sävel:, säv:, sov:, sanat: "
+            'sekä "lainausmerkit" tarkalle fraasille ja "sanat lähekkäin"~3\n\n'
+            f"📚 Tietokannassa on {song_db.song_count()} laulua Fiisut-V kokoelmasta.\n\n"
             "🇬🇧 For English instructions, use /english"
         )
 
-    await update.message.reply_text(
-        message_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True
-    )
+    send_long_message(update, message_text)
 
 
 async def send_help_message_english(
@@ -330,8 +3367,13 @@ async def send_help_message_english(
             "<b>Examples:</b>\n"
             "• /fiisu teemu\n"
             "• /fiisu juomalaulu (drinking song)\n"
-            "• /fiisu polyteknikko (polytechnic)\n\n"
-            f"📚 Database contains {len(song_db.songs)} songs from the Fiisut-V collection.\n\n"
+            "• /fiisu polyteknikko (polytechnic)\n"
+            "• /fiisu sävel: helan går (to the tune of)\n\n"
+            "🎶 Many songs at once: /setlist with one title per line\n\n"
+            "<b>Filters:</b> nimi: (name), sävel: (tune), säv: (composer), "
+            'sov: (arranger), sanat: (lyrics), "quotes" for exact phrases '
+            'and "words nearby"~3\n\n'
+            f"📚 Database contains {song_db.song_count()} songs from the Fiisut-V collection.\n\n"
             "🇫🇮 Suomenkieliset ohjeet: /help"
         )
     else:
@@ -342,14 +3384,17 @@ async def send_help_message_english(
             "<b>Examples:</b>\n"
             "• /fiisu teemu\n"
             "• /fiisu juomalaulu (drinking song)\n"
-            "• /fiisu polyteknikko (polytechnic)\n\n"
-            f"📚 Database contains {len(song_db.songs)} songs from the Fiisut-V collection.\n\n"
+            "• /fiisu polyteknikko (polytechnic)\n"
+            "• /fiisu sävel: helan går (to the tune of)\n\n"
+            "🎶 Many songs at once: /setlist with one title per line\n\n"
+            "<b>Filters:</b> nimi: (name), sävel: (tune), säv: (composer), "
+            'sov: (arranger), sanat: (lyrics), "quotes" for exact phrases '
+            'and "words nearby"~3\n\n'
+            f"📚 Database contains {song_db.song_count()} songs from the Fiisut-V collection.\n\n"
             "🇫🇮 Suomenkieliset ohjeet: /help"
         )
 
-    await update.message.reply_text(
-        message_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True
-    )
+    send_long_message(update, message_text)
 
 
 async def handle_private_message(
@@ -368,18 +3413,347 @@ async def handle_private_message(
     await fiisu_command_handler(update, context)
 
 
+def inline_result(idx: int) -> InlineQueryResultArticle:
+    """Inline result that sends a full song."""
+    from telegram import (  # pylint: disable=import-outside-toplevel
+        InlineQueryResultArticle,
+        InputTextMessageContent,
+    )
+
+    song = song_db.song(idx)
+    lyrics = song.get("lyrics", "")
+    return InlineQueryResultArticle(
+        id=str(idx),
+        title=song.get("name", "Unknown Song"),
+        description=escape_html(lyrics.split("\n")[0]) if lyrics else None,
+        input_message_content=InputTextMessageContent(
+            truncate_message(render_song_at(idx)), parse_mode="HTML"
+        ),
+    )
+
+
+async def handle_inline_query(
+    update: Update, _context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Complete a song name or lyrics word as the user types it inline."""
+    inline_query = update.inline_query
+    query = inline_query.query
+    if not query.strip():
+        await inline_query.answer([], cache_time=INLINE_CACHE_SECONDS)
+        return
+
+    # Most keystrokes are a precomputed prefix, the rest need a search
+    indexes = song_db.complete(query)  # pylint: disable=assignment-from-none
+    if indexes is None:
+        hits = await search_flight.do(
+            "inline:" + normalize_query(query),
+            lambda: song_db.search_hits(query, limit=COMPLETIONS_PER_PREFIX),
+        )
+        indexes = tuple(hit.index for hit in hits)
+
+    await inline_query.answer(
+        [inline_result(idx) for idx in indexes], cache_time=INLINE_CACHE_SECONDS
+    )
+
+
+# Telegram user ids allowed to use admin commands such as /profile
+ADMIN_USER_IDS = frozenset(
+    int(user_id)
+    for user_id in os.getenv("ADMIN_USER_IDS", "").split(",")
+    if user_id.strip()
+)
+# Where profiles are written, how often stacks are sampled, and how long
+# profiles started without a length last
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_UPDATES = int(os.getenv("PROFILE_UPDATES", "100"))
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "60"))
+# Innermost functions of threads that are waiting rather than working
+IDLE_FUNCTIONS = frozenset({"select", "wait", "_worker", "poll", "accept"})
+
+
+class RuntimeProfiler:
+    """
+    Samples the stacks of all threads for a while, so that time spent
+    searching and rendering in worker threads shows up as well as time on
+    the event loop, and measures how late the event loop wakes up.
+    """
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        # Number of samples of each stack, outermost call first
+        self.samples: Counter = Counter()
+        # How much later than asked the event loop woke up, in seconds
+        self.lags: List[float] = []
+        self.updates_left = 0
+        self.started = 0.0
+        self.sampler: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.tasks: List["asyncio.Task[None]"] = []
+        # Admin command that started the profile, answered with the summary
+        self.requester: Optional[Update] = None
+
+    @property
+    def running(self) -> bool:
+        return self.sampler is not None
+
+    def start(
+        self,
+        updates: int = 0,
+        seconds: float = 0.0,
+        requester: Optional[Update] = None,
+    ) -> bool:
+        """
+        Profile until `updates` more updates have been handled or `seconds`
+        have passed. Returns False if a profile is already running.
+        """
+        if self.running:
+            return False
+        self.samples = Counter()
+        self.lags = []
+        self.updates_left = updates
+        self.requester = requester
+        self.started = time.monotonic()
+        self.stopping.clear()
+        self.sampler = threading.Thread(
+            target=self._sample, name="profiler", daemon=True
+        )
+        self.sampler.start()
+        self.tasks = [asyncio.create_task(self._measure_lag())]
+        if seconds > 0:
+            self.tasks.append(asyncio.create_task(self._stop_after(seconds)))
+        logger.info("Profiling for %d updates or %.0f seconds", updates, seconds)
+        return True
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for thread_id, frame in frames.items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} "
+                        f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                self.samples[tuple(reversed(stack))] += 1
+
+    async def _measure_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(loop.time() - started - self.interval)
+
+    async def _stop_after(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        await self.stop()
+
+    def count_update(self) -> None:
+        """Count a handled update, stopping the profile after the last one."""
+        if self.running and self.updates_left > 0:
+            self.updates_left -= 1
+            if self.updates_left == 0:
+                background_tasks.append(asyncio.create_task(self.stop()))
+
+    def summary(self) -> str:
+        """
+        Where the busy samples were: the functions of this module they were
+        in, which shows searching against rendering, and the innermost
+        functions, which shows e.g. time in Telegram requests. Then the lag.
+        """
+        own_file = os.path.basename(__file__)
+        total = sum(self.samples.values())
+        busy_total = 0
+        inside: Counter = Counter()
+        innermost: Counter = Counter()
+        for stack, count in self.samples.items():
+            if stack[-1].split(" ", 1)[0] in IDLE_FUNCTIONS:
+                continue
+            busy_total += count
+            innermost[stack[-1]] += count
+            # Counted once per stack, also for recursive functions
+            for function in set(stack):
+                if f"({own_file}:" in function:
+                    inside[function] += count
+
+        def percent(count: int) -> str:
+            return f"{count * 100 / max(busy_total, 1):5.1f}%"
+
+        lines = [
+            f"{time.monotonic() - self.started:.0f} s, "
+            f"{busy_total} of {total} samples busy",
+            "",
+            "In this module:",
+        ]
+        lines += [f"{percent(count)} {name}" for name, count in inside.most_common(10)]
+        lines += ["", "Innermost:"]
+        lines += [
+            f"{percent(count)} {name}" for name, count in innermost.most_common(10)
+        ]
+        if self.lags:
+            lags = sorted(self.lags)
+            lines += [
+                "",
+                f"Event loop lag: mean {sum(lags) / len(lags) * 1000:.1f} ms, "
+                f"p95 {lags[int(len(lags) * 0.95)] * 1000:.1f} ms, "
+                f"max {lags[-1] * 1000:.1f} ms",
+            ]
+        return "\n".join(lines)
+
+    def _write(self) -> str:
+        """Write the samples as folded stacks, one `a;b;c count` line each."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory,
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded",
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.samples.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+        return path
+
+    async def stop(self) -> None:
+        """Stop profiling, write the profile and report its summary."""
+        if self.sampler is None:
+            return
+        sampler, self.sampler = self.sampler, None
+        self.stopping.set()
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        await asyncio.to_thread(sampler.join)
+
+        summary = self.summary()
+        try:
+            path = await asyncio.to_thread(self._write)
+        except OSError as e:
+            logger.error("Error writing profile to %s: %s", self.directory, e)
+            path = "-"
+        logger.info("Profile written to %s\n%s", path, summary)
+        if self.requester is not None:
+            send_long_message(
+                self.requester,
+                f"📊 Profiili tallennettu: {html.escape(path)}\n\n"
+                f"<pre>{html.escape(summary)}</pre>",
+            )
+
+
+profiler = RuntimeProfiler(PROFILE_DIR, PROFILE_INTERVAL)
+
+
+async def profile_command_handler(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """
+    Handle /profile for admins: `/profile 200` profiles the next 200
+    updates, `/profile 30s` the next 30 seconds and `/profile stop` stops.
+    """
+    user = update.effective_user
+    if user is None or user.id not in ADMIN_USER_IDS:
+        logger.warning("Ignoring /profile from non-admin %s", user and user.id)
+        return
+
+    argument = context.args[0].lower() if context.args else ""
+    if argument == "stop":
+        if not profiler.running:
+            send_long_message(update, "Profilointi ei ole käynnissä.")
+        await profiler.stop()
+        return
+
+    try:
+        if argument.endswith("s"):
+            updates, seconds = 0, float(argument[:-1])
+        else:
+            updates, seconds = int(argument or PROFILE_UPDATES), 0.0
+        # Without a positive limit the profile would run until stopped
+        if not (updates > 0 or 0 < seconds < math.inf):
+            raise ValueError(argument)
+    except ValueError:
+        send_long_message(update, "Käyttö: /profile [päivityksiä | sekunteja s | stop]")
+        return
+
+    if not profiler.start(updates, seconds, requester=update):
+        send_long_message(update, "Profilointi on jo käynnissä.")
+        return
+    length = f"{seconds:.0f} sekuntia" if seconds else f"{updates} päivitystä"
+    send_long_message(update, f"📊 Profiloidaan seuraavat {length}.")
+
+
+async def count_profiled_update(
+    _update: Update, _context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Count each handled update towards a running profile."""
+    profiler.count_update()
+
+
+def toggle_profiling() -> None:
+    """Start a profile of PROFILE_SECONDS, or stop the running one, on SIGUSR1."""
+    if profiler.running:
+        background_tasks.append(asyncio.create_task(profiler.stop()))
+    else:
+        profiler.start(seconds=PROFILE_SECONDS)
+
+
 async def handle_error(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle errors."""
     logger.error("Update %s caused error %s", update, context.error)
 
 
+def load_songs() -> None:
+    """Open the songs and rank them by earlier views, timing each stage."""
+    global song_db  # pylint: disable=global-statement
+    song_db = open_song_database()
+    startup_timings.update(song_db.load_timings())
+
+    started = time.perf_counter()
+    popularity.load()
+    song_db.set_popularity(popularity.views)
+    startup_timings["popularity"] = time.perf_counter() - started
+
+
+def warm_up() -> None:
+    """Render the most viewed songs so the first requests for them are fast."""
+    started = time.perf_counter()
+    warm = song_db.most_popular(WARM_SONGS)
+    for idx in warm:
+        render_song_at(idx)
+    logger.info(
+        "Pre-rendered %d most viewed songs in %.0f ms",
+        len(warm),
+        (time.perf_counter() - started) * 1000,
+    )
+
+
 async def post_init(application: Application):
     """Initialize handlers after application is built."""
+    from telegram.ext import (  # pylint: disable=import-outside-toplevel
+        CallbackQueryHandler,
+        CommandHandler,
+        InlineQueryHandler,
+        MessageHandler,
+        TypeHandler,
+        filters,
+    )
+    from telegram import Update  # pylint: disable=import-outside-toplevel
+
     # Commands work in both private chats and groups
     application.add_handler(CommandHandler("start", send_help_message))
     application.add_handler(CommandHandler("help", send_help_message))
     application.add_handler(CommandHandler("english", send_help_message_english))
     application.add_handler(CommandHandler("fiisu", fiisu_command_handler))
+    application.add_handler(CommandHandler("setlist", setlist_command_handler))
+    application.add_handler(CommandHandler("profile", profile_command_handler))
+    application.add_handler(
+        CallbackQueryHandler(handle_result_button, pattern=r"^fiisu:")
+    )
+    # Inline mode must be enabled with @BotFather for these to arrive
+    application.add_handler(InlineQueryHandler(handle_inline_query))
 
     # Private messages (non-commands) are treated as search queries
     application.add_handler(
@@ -388,26 +3762,522 @@ async def post_init(application: Application):
         )
     )
 
+    # Runs after the handlers above, counting updates for /profile
+    application.add_handler(TypeHandler(Update, count_profiled_update), group=1)
+
     application.add_error_handler(handle_error)
 
-    logger.info("Post init done.")
+    started = time.perf_counter()
+    # Workers inherit the songs, loaded and pre-rendered, from the process
+    # that forked them, which also reloads them by forking new workers
+    if multiprocessing.parent_process() is None:
+        load_songs()
+        # Have the most viewed songs ready to send
+        if WARM_IN_BACKGROUND:
+            background_tasks.append(asyncio.create_task(asyncio.to_thread(warm_up)))
+        else:
+            warm_up()
+
+        if COLLECTION_CHECK_SECONDS > 0 and song_db.versions():
+            background_tasks.append(asyncio.create_task(watch_collections()))
+        if RELOAD_SOCKET:
+            background_tasks.append(
+                asyncio.create_task(
+                    serve_reload_socket(RELOAD_SOCKET, reload_collections)
+                )
+            )
+        # SIGHUP reloads changed collections right away
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP,
+                lambda: background_tasks.append(
+                    asyncio.create_task(reload_collections())
+                ),
+            )
+    popularity.start()
+    query_log.start()
+    # SIGUSR1 toggles profiling
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_profiling)
+
+    startup_timings["startup"] = time.perf_counter() - started
+    logger.info(
+        "Post init done. Startup report: %s",
+        ", ".join(
+            f"{stage} {seconds * 1000:.0f} ms"
+            for stage, seconds in startup_timings.items()
+        ),
+    )
+
+
+async def post_stop(_application: Application):
+    """Flush queued outgoing messages and view counts before shutting down."""
+    await profiler.stop()
+    await message_scheduler.drain()
+    await popularity.stop()
+    await asyncio.to_thread(query_log.stop)
+    for task in background_tasks:
+        task.cancel()
+    logger.info("Send queue stats at shutdown: %s", message_scheduler.stats())
+
+
+@dataclass
+class WebhookSettings:
+    """Webhook deployment settings read from the environment."""
+
+    url: str
+    listen: str = "0.0.0.0"
+    port: int = 8080
+    path: str = "/telegram"
+    secret_token: Optional[str] = None
+    health_path: str = "/healthz"
+    drain_seconds: float = 0.0
+
+    @property
+    def webhook_url(self) -> str:
+        """Public URL that Telegram posts updates to."""
+        return self.url.rstrip("/") + self.path
+
+    @classmethod
+    def from_env(cls) -> Optional["WebhookSettings"]:
+        """Read webhook settings, or return None if webhook mode is not enabled."""
+        url = os.getenv("WEBHOOK_URL")
+        if not url:
+            return None
+
+        path = os.getenv("WEBHOOK_PATH", "/telegram")
+        if not path.startswith("/"):
+            path = "/" + path
+
+        return cls(
+            url=url,
+            listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8080")),
+            path=path,
+            secret_token=os.getenv("WEBHOOK_SECRET_TOKEN") or None,
+            health_path=os.getenv("WEBHOOK_HEALTH_PATH", "/healthz"),
+            drain_seconds=float(os.getenv("WEBHOOK_DRAIN_SECONDS", "0")),
+        )
+
+
+def build_webhook_app(
+    settings: WebhookSettings,
+    state: Dict[str, bool],
+    deliver: Callable[[Dict[str, Any]], Awaitable[None]],
+    status: Callable[[], Dict[str, Any]],
+):
+    """
+    Build the tornado app serving the webhook and health-check routes.
+    `deliver` hands on each update and `status` reports health.
+    """
+    # Tornado comes with python-telegram-bot[webhooks], only needed in this mode
+    import tornado.web  # pylint: disable=import-outside-toplevel
+
+    class TelegramUpdateHandler(  # pylint: disable=abstract-method
+        tornado.web.RequestHandler
+    ):
+        """Receive updates posted by Telegram and deliver them."""
+
+        async def post(self) -> None:
+            # Reject requests that don't carry the secret token we registered
+            if settings.secret_token:
+                received = self.request.headers.get(
+                    "X-Telegram-Bot-Api-Secret-Token", ""
+                )
+                if not hmac.compare_digest(received, settings.secret_token):
+                    self.set_status(403)
+                    return
+
+            try:
+                await deliver(json.loads(self.request.body))
+            except (ValueError, TypeError) as e:
+                logger.warning("Received invalid webhook payload: %s", e)
+                self.set_status(400)
+                return
+
+            self.set_status(200)
+
+    class HealthCheckHandler(  # pylint: disable=abstract-method
+        tornado.web.RequestHandler
+    ):
+        """Report whether this replica should receive traffic."""
+
+        def get(self) -> None:
+            if state["draining"]:
+                self.set_status(503)
+                self.write({"status": "draining"})
+                return
+
+            report = status()
+            if report["status"] != "ok":
+                self.set_status(503)
+            self.write(report)
+
+    return tornado.web.Application(
+        [
+            (settings.path, TelegramUpdateHandler),
+            (settings.health_path, HealthCheckHandler),
+        ]
+    )
+
+
+async def serve_webhook(application: Application, settings: WebhookSettings) -> None:
+    """Serve updates through a webhook until SIGINT/SIGTERM, then drain."""
+    from telegram import Update  # pylint: disable=import-outside-toplevel
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def deliver(data: Dict[str, Any]) -> None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    def status() -> Dict[str, Any]:
+        return {
+            "status": "ok",
+            "songs": song_db.song_count(),
+            "collections": song_db.versions(),
+            "send_queue": message_scheduler.stats(),
+        }
+
+    state = {"draining": False}
+    web_app = build_webhook_app(settings, state, deliver, status)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+
+        # Every replica registers the same URL, so this is safe to repeat
+        await application.bot.set_webhook(
+            url=settings.webhook_url,
+            secret_token=settings.secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+
+        server = web_app.listen(settings.port, address=settings.listen, xheaders=True)
+        logger.info(
+            "Listening for webhook updates on %s:%d%s",
+            settings.listen,
+            settings.port,
+            settings.path,
+        )
+
+        await stop_event.wait()
+
+        # Fail health checks first so a load balancer stops routing to us,
+        # but keep accepting updates that are already on their way
+        logger.info("Shutting down, draining in-flight updates...")
+        state["draining"] = True
+        if settings.drain_seconds > 0:
+            await asyncio.sleep(settings.drain_seconds)
+
+        server.stop()
+        await server.close_all_connections()
+
+        # Application.stop() processes everything left in the update queue
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+
+    logger.info("Webhook server stopped.")
+
+
+# Worker processes serving webhook updates, 1 to serve them in this process
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+
+
+def update_route(data: Dict[str, Any]) -> int:
+    """
+    Chat of an update, or its sender if it has no chat, so that everything
+    from one chat goes to the same worker: result buttons find the result
+    sets stored by that worker and per-chat send limits hold.
+    """
+    for value in data.values():
+        if isinstance(value, dict):
+            message = value.get("message") or value
+            return int((message.get("chat") or value.get("from") or {}).get("id", 0))
+    return 0
+
+
+async def serve_worker(
+    application: Application,
+    updates: "multiprocessing.Queue[Optional[Dict[str, Any]]]",
+    settings: Optional[WebhookSettings],
+) -> None:
+    """
+    Process the updates the supervisor passes on until it sends None.
+    With `settings`, register the webhook for all workers.
+    """
+    from telegram import Update  # pylint: disable=import-outside-toplevel
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        if settings:
+            await application.bot.set_webhook(
+                url=settings.webhook_url,
+                secret_token=settings.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+
+        while True:
+            data = await asyncio.to_thread(updates.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError) as e:
+                logger.warning("Received invalid update: %s", e)
+                continue
+            await application.update_queue.put(update)
+
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+
+
+def run_worker(
+    number: int,
+    updates: "multiprocessing.Queue[Optional[Dict[str, Any]]]",
+    counts: "multiprocessing.Queue[Optional[Tuple[Counter, Counter]]]",
+    settings: Optional[WebhookSettings],
+    bot_token: str,
+) -> None:
+    """Entry point of a worker process forked by `start_workers`."""
+    # The supervisor stops the workers once it has drained the webhook, and
+    # reloads the songs by forking new workers
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_IGN)
+    # Workers forked by a reload would otherwise wake the supervisor's loop
+    signal.set_wakeup_fd(-1)
+    background_tasks.clear()
+    song_db.after_fork()
+    popularity.forward(counts)
+    # Rotating one file from several processes would lose events. Workers
+    # replaced on reload share their numbers with the ones they replace
+    if query_log.path:
+        query_log.path = f"{query_log.path}.{os.getpid()}"
+    # Each worker sends to its own chats, sharing the global send limit
+    rate = message_scheduler.global_bucket.rate / WEBHOOK_WORKERS
+    message_scheduler.global_bucket = TokenBucket(rate, rate)
+
+    application = build_application(bot_token, webhook=True)
+    logger.info("Worker %d started", number)
+    asyncio.run(serve_worker(application, updates, settings))
+    logger.info("Worker %d stopped", number)
+
+
+def start_workers(
+    context: "multiprocessing.context.BaseContext",
+    counts: "multiprocessing.Queue[Optional[Tuple[Counter, Counter]]]",
+    settings: Optional[WebhookSettings],
+    bot_token: str,
+) -> Tuple[
+    "List[multiprocessing.Queue[Optional[Dict[str, Any]]]]",
+    List["multiprocessing.process.BaseProcess"],
+]:
+    """
+    Fork `WEBHOOK_WORKERS` workers that share the loaded songs, each with a
+    queue of updates. With `settings`, the first one registers the webhook.
+    """
+    # Keep the garbage collector from writing to the loaded objects, which
+    # would copy their memory pages into every worker
+    gc.collect()
+    gc.freeze()
+    queues: "List[multiprocessing.Queue[Optional[Dict[str, Any]]]]" = [
+        context.Queue() for _ in range(WEBHOOK_WORKERS)
+    ]
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(number, queue, counts, settings if number == 0 else None, bot_token),
+            name=f"worker-{number}",
+        )
+        for number, queue in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+    return queues, workers
+
+
+async def supervise_workers(
+    settings: WebhookSettings,
+    bot_token: str,
+    context: "multiprocessing.context.BaseContext",
+    counts: "multiprocessing.Queue[Optional[Tuple[Counter, Counter]]]",
+) -> None:
+    """
+    Fork the workers and serve the webhook, passing the updates of each chat
+    to one worker. Collections are reloaded here, and new workers forked with
+    them replace the old ones, so that the workers keep sharing the songs.
+    """
+    queues, workers = start_workers(context, counts, settings, bot_token)
+    # Replaced workers still finishing the updates queued for them
+    retiring: List["asyncio.Task[None]"] = []
+    reload_lock = asyncio.Lock()
+
+    async def reload_workers() -> List[str]:
+        async with reload_lock:
+            reloaded = await reload_collections()
+            if not reloaded:
+                return reloaded
+            await asyncio.to_thread(warm_up)
+            # Let the collector free the replaced songs before freezing again
+            gc.unfreeze()
+            old_queues, old_workers = list(queues), list(workers)
+            queues[:], workers[:] = start_workers(context, counts, None, bot_token)
+            retiring[:] = [task for task in retiring if not task.done()]
+            for queue, worker in zip(old_queues, old_workers):
+                queue.put(None)
+                retiring.append(asyncio.create_task(asyncio.to_thread(worker.join)))
+            logger.info("Replaced %d workers with reloaded songs", len(workers))
+            return reloaded
+
+    async def count_views() -> None:
+        # Workers send the views they counted, this process writes them
+        while True:
+            forwarded = await asyncio.to_thread(counts.get)
+            if forwarded is None:
+                break
+            popularity.add(*forwarded)
+
+    tasks = [asyncio.create_task(count_views())]
+    popularity.start()
+    if COLLECTION_CHECK_SECONDS > 0 and song_db.versions():
+        tasks.append(asyncio.create_task(watch_collections(reload_workers)))
+    if RELOAD_SOCKET:
+        tasks.append(
+            asyncio.create_task(serve_reload_socket(RELOAD_SOCKET, reload_workers))
+        )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    # SIGHUP reloads changed collections now, SIGUSR1 toggles profiling in
+    # all workers
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(
+            signal.SIGHUP,
+            lambda: tasks.append(asyncio.create_task(reload_workers())),
+        )
+        loop.add_signal_handler(
+            signal.SIGUSR1,
+            lambda: [os.kill(worker.pid, signal.SIGUSR1) for worker in workers],
+        )
+
+    async def deliver(data: Dict[str, Any]) -> None:
+        queues[update_route(data) % len(queues)].put(data)
+
+    def status() -> Dict[str, Any]:
+        alive = sum(worker.is_alive() for worker in workers)
+        return {
+            # A worker that died leaves its chats without answers
+            "status": "ok" if alive == len(workers) else "worker stopped",
+            "songs": song_db.song_count(),
+            "workers": alive,
+        }
+
+    state = {"draining": False}
+    web_app = build_webhook_app(settings, state, deliver, status)
+    server = web_app.listen(settings.port, address=settings.listen, xheaders=True)
+    logger.info(
+        "Listening for webhook updates on %s:%d%s with %d workers",
+        settings.listen,
+        settings.port,
+        settings.path,
+        len(workers),
+    )
+
+    await stop_event.wait()
+
+    logger.info("Shutting down, draining in-flight updates...")
+    state["draining"] = True
+    if settings.drain_seconds > 0:
+        await asyncio.sleep(settings.drain_seconds)
+
+    server.stop()
+    await server.close_all_connections()
+
+    for task in tasks[1:]:
+        task.cancel()
+    async with reload_lock:
+        # Workers finish the updates queued before the None
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            await asyncio.to_thread(worker.join)
+        await asyncio.gather(*retiring)
+    # Then write the views the workers sent when they stopped
+    counts.put(None)
+    await tasks[0]
+    await popularity.stop()
+    logger.info("Webhook server stopped.")
+
+
+def serve_workers(settings: WebhookSettings, bot_token: str) -> None:
+    """
+    Load the songs once and serve the webhook with `WEBHOOK_WORKERS` worker
+    processes forked to share them.
+    """
+    load_songs()
+    warm_up()
+    context = multiprocessing.get_context("fork")
+    counts: "multiprocessing.Queue[Optional[Tuple[Counter, Counter]]]" = context.Queue()
+    asyncio.run(supervise_workers(settings, bot_token, context, counts))
+
+
+def build_application(bot_token: str, webhook: bool) -> Application:
+    """Build the bot application, without an updater when using a webhook."""
+    from telegram.ext import Application  # pylint: disable=import-outside-toplevel
+
+    # Handlers only queue their replies, so many can run at once, and
+    # identical searches running at once share one search
+    concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "32"))
+    builder = (
+        Application.builder()
+        .token(bot_token)
+        .concurrent_updates(concurrent_updates or False)
+    )
+    if webhook:
+        # Updates arrive through our own webhook server instead of the updater
+        builder = builder.updater(None)
+    app = builder.build()
+    app.post_init = post_init
+    app.post_stop = post_stop
+    return app
 
 
 def main() -> None:
     """Start the bot."""
+    # The Telegram library is the bulk of the import time
+    started = time.perf_counter()
+    import telegram.ext  # pylint: disable=import-outside-toplevel,unused-import
+
+    startup_timings["imports"] = time.perf_counter() - started
+
     # Get bot token from environment
     bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not bot_token:
         logger.error("TELEGRAM_BOT_TOKEN environment variable not set")
         raise ValueError("Bot token not provided")
 
-    # Create application
-    app = Application.builder().token(bot_token).concurrent_updates(False).build()
-    app.post_init = post_init
+    webhook_settings = WebhookSettings.from_env()
 
     # Start the bot
     logger.info("Starting Fiisut Telegram Bot...")
-    app.run_polling()
+    if webhook_settings and WEBHOOK_WORKERS > 1:
+        serve_workers(webhook_settings, bot_token)
+        return
+
+    app = build_application(bot_token, webhook=bool(webhook_settings))
+    if webhook_settings:
+        asyncio.run(serve_webhook(app, webhook_settings))
+    else:
+        app.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+import pytest
+
+from fiisubot import MessageScheduler
+
+
+def scheduler(**limits) -> MessageScheduler:
+    return MessageScheduler(global_rate=1000, **limits)
+
+
+def send_text(sent, text):
+    async def send():
+        sent.append(text)
+        return text
+
+    return send
+
+
+@pytest.mark.asyncio
+async def test_chunks_of_a_job_are_sent_in_order():
+    sent = []
+    messages = await scheduler().submit(
+        1, [send_text(sent, text) for text in ["a", "b", "c"]]
+    )
+    assert messages == sent == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_chat_limit_holds_between_replies():
+    limiter = scheduler(group_rate=20, burst=2)
+    sent = []
+    started = time.monotonic()
+    # Each reply is awaited before the next, so the chat's queue empties
+    for i in range(6):
+        await limiter.submit(1, [send_text(sent, i)], group=True)
+    # Two sends from the burst, the other four at 20 per second
+    assert time.monotonic() - started >= 0.19
+    assert sent == list(range(6))
+
+
+@pytest.mark.asyncio
+async def test_chats_are_limited_separately():
+    limiter = scheduler(private_rate=1, burst=1)
+    sent = []
+    started = time.monotonic()
+    await asyncio.gather(
+        *(limiter.submit(chat_id, [send_text(sent, chat_id)]) for chat_id in range(5))
+    )
+    assert time.monotonic() - started < 0.5
+    assert sorted(sent) == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_full_queue_drops_job():
+    limiter = scheduler(private_rate=1, burst=1, max_queue=2)
+    sent = []
+    futures = [limiter.submit(1, [send_text(sent, i)]) for i in range(3)]
+    assert futures[2].cancelled()
+    assert limiter.stats()["dropped"] == 1
+    await asyncio.gather(*futures[:2])
+
+
+@pytest.mark.asyncio
+async def test_refilled_buckets_of_idle_chats_are_forgotten():
+    limiter = scheduler(private_rate=1000, burst=1)
+    limiter.bucket_sweep_interval = 0
+    await limiter.submit(1, [send_text([], 1)])
+    await asyncio.sleep(0.01)
+    await limiter.submit(2, [send_text([], 2)])
+    assert 1 not in limiter.buckets
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+import pytest
+
+import fiisubot
+from fiisubot import PopularityTracker, SongDatabase
+from test_song_database import SONGS, write_songs
+
+
+class RecordingBackend:
+    def __init__(self):
+        self.calls = []
+
+    def set_popularity(self, views):
+        self.calls.append((dict(views), threading.current_thread()))
+
+
+@pytest.mark.asyncio
+async def test_new_views_reorder_songs_off_the_event_loop(monkeypatch):
+    backend = RecordingBackend()
+    monkeypatch.setattr(fiisubot, "song_db", backend)
+    tracker = PopularityTracker("", flush_interval=0.01)
+    tracker.record_view({"name": "Teemu"})
+    tracker.start()
+    await asyncio.sleep(0.1)
+    await tracker.stop()
+
+    # Reordered once for the view, not again on later flushes without views
+    assert len(backend.calls) == 1
+    views, thread = backend.calls[0]
+    assert views == {"Teemu": 1}
+    assert thread is not threading.main_thread()
+
+
+def test_searches_run_while_the_popularity_order_is_rebuilt(tmp_path, monkeypatch):
+    db = SongDatabase(write_songs(tmp_path, SONGS))
+    building, searched = threading.Event(), threading.Event()
+    build_completions = db.build_completions
+
+    def slow_build_completions(tie_order):
+        building.set()
+        # Holds up the rebuild until a search has finished meanwhile
+        searched.wait(5)
+        return build_completions(tie_order)
+
+    monkeypatch.setattr(db, "build_completions", slow_build_completions)
+    reorder = threading.Thread(target=db.set_popularity, args=({"Sitsilaulu": 3},))
+    reorder.start()
+    assert building.wait(5)
+    assert db.search_hits("teemu", 10)
+    searched.set()
+    reorder.join()
+    assert db.most_popular(1) == [3]
+    assert db.complete("s")[0] == 3
@@ -0,0 +1,21 @@
+from types import SimpleNamespace
+
+import pytest
+
+import fiisubot
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("argument", ["0", "-5", "0s", "-1s", "infs", "nans"])
+async def test_profiles_need_a_positive_limit(monkeypatch, argument):
+    sent = []
+    monkeypatch.setattr(fiisubot, "ADMIN_USER_IDS", frozenset({1}))
+    monkeypatch.setattr(
+        fiisubot, "send_long_message", lambda update, text, **kwargs: sent.append(text)
+    )
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=1))
+    context = SimpleNamespace(args=[argument])
+
+    await fiisubot.profile_command_handler(update, context)
+    assert not fiisubot.profiler.running
+    assert sent and sent[0].startswith("Käyttö: /profile")
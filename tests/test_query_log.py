@@ -0,0 +1,48 @@
+import json
+
+from fiisubot import QueryLog, SearchHit
+
+
+def hit(song_id):
+    return SearchHit({"id": song_id}, 0)
+
+
+def test_events_are_written_as_json_lines(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    log = QueryLog(str(path))
+    log.start()
+    log.log("teemu", [hit("teemu#0"), hit("teemu#1")], 0.0042, "private")
+    log.log("temu", [], 0.001, "group", suggestions=[hit("teemu#0")])
+    log.stop()
+
+    found, missing = [json.loads(line) for line in path.read_text().splitlines()]
+    assert found["results"] == ["teemu#0", "teemu#1"]
+    assert found["count"] == 2
+    assert found["suggested"] == []
+    assert found["ms"] == 4.2
+    assert found["chat_type"] == "private"
+    # Suggestions aren't results of the search
+    assert missing["count"] == 0
+    assert missing["results"] == []
+    assert missing["suggested"] == ["teemu#0"]
+
+
+def test_unsampled_searches_are_left_out(tmp_path):
+    path = tmp_path / "queries.jsonl"
+    log = QueryLog(str(path), sample=0)
+    log.start()
+    log.log("teemu", [hit("teemu#0")], 0.001, "private")
+    log.stop()
+    assert not path.exists()
+
+
+def test_full_queue_drops_events_instead_of_waiting(tmp_path):
+    log = QueryLog(str(tmp_path / "queries.jsonl"), queue_size=1)
+    log.start()
+    # Nothing is written while the writer thread is stopped
+    log.listener.stop()
+    log.log("a", [], 0.001, "private")
+    log.log("b", [], 0.001, "private")
+    assert log.handler.dropped == 1
+    log.listener.start()
+    log.stop()
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import fiisubot
+from fiisubot import RecentReplies, SingleFlight, build_application
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_searches_share_one_run():
+    flight = SingleFlight()
+    runs = []
+
+    def search():
+        runs.append(1)
+        time.sleep(0.05)
+        return ["Teemu"]
+
+    results = await asyncio.gather(*(flight.do("teemu", search) for _ in range(5)))
+    assert results == [["Teemu"]] * 5
+    assert len(runs) == 1
+    assert not flight.in_flight
+
+
+def test_updates_are_handled_concurrently_by_default(monkeypatch):
+    monkeypatch.delenv("CONCURRENT_UPDATES", raising=False)
+    application = build_application("123:token", webhook=True)
+    # Otherwise two identical searches can never be in flight at once
+    assert application.concurrent_updates > 1
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_at_once_in_a_chat_get_one_reply(monkeypatch):
+    sent, pointers = [], []
+
+    def search_and_render(query):
+        time.sleep(0.05)
+        return [], f"Ei tuloksia: {query}", False, False
+
+    def send_long_message(update, text, reply_markup=None):
+        sent.append(text)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(["message"])
+        return future
+
+    monkeypatch.setattr(fiisubot, "recent_replies", RecentReplies(60))
+    monkeypatch.setattr(fiisubot, "search_flight", SingleFlight())
+    monkeypatch.setattr(fiisubot, "search_and_render", search_and_render)
+    monkeypatch.setattr(fiisubot, "send_long_message", send_long_message)
+    monkeypatch.setattr(
+        fiisubot,
+        "send_pointer_to_earlier",
+        lambda update, earlier: pointers.append(earlier.result()),
+    )
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1, type="group"))
+    context = SimpleNamespace(args=["teemu"])
+
+    await asyncio.gather(
+        *(fiisubot.fiisu_command_handler(update, context) for _ in range(3))
+    )
+    assert sent == ["Ei tuloksia: teemu"]
+    assert pointers == [["message"], ["message"]]
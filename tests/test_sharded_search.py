@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from extract_songs import write_sqlite_database
+from fiisubot import ShardedSongDatabase
+
+
+def song(key, name, lyrics):
+    return {
+        "id": key,
+        "name": name,
+        "melody": None,
+        "composer": None,
+        "arranger": None,
+        "notes": None,
+        "lyrics": lyrics,
+    }
+
+
+# Only lyrics match in the first shard, which has more matches
+LYRICS_SHARD = [
+    song(f"malja#{i}", f"Malja {i}", f"Nostetaan malja\nkaikille ystäville {i}")
+    for i in range(12)
+]
+NAME_SHARD = [
+    song("kippis#0", "Kippis kaikille", "Kippis vaan\nja hyvää yötä"),
+    song("muu#0", "Muu laulu", "Tässä ei ole sitä sanaa"),
+]
+
+
+def write_collection(directory, songs):
+    directory.mkdir()
+    (directory / "songs.json").write_text(
+        json.dumps(songs, ensure_ascii=False), encoding="utf-8"
+    )
+    write_sqlite_database(songs, str(directory / "songs.sqlite3"))
+    return str(directory)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_name_match_beats_lyrics_matches_of_other_shards(
+    tmp_path, monkeypatch, backend
+):
+    monkeypatch.setenv("SONG_BACKEND", backend)
+    db = ShardedSongDatabase(
+        {
+            "maljat": write_collection(tmp_path / "maljat", LYRICS_SHARD),
+            "kippis": write_collection(tmp_path / "kippis", NAME_SHARD),
+        }
+    )
+    hits = db.search_hits("kaikille", 20)
+    assert hits[0].song["name"] == "Kippis kaikille"
+    assert len(hits) == len(LYRICS_SHARD) + 1
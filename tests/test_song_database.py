@@ -0,0 +1,195 @@
+import copy
+import json
+import zlib
+
+import pytest
+
+import fiisubot
+from extract_songs import build_similarity_index, write_sqlite_database
+from fiisubot import CompressedLyrics, SongDatabase, SqliteSongDatabase, song_key
+
+SONGS = [
+    {
+        "id": "teemu#0",
+        "name": "Teemu",
+        "melody": "Helan går",
+        "composer": None,
+        "lyrics": "Teemu on kaunis poika\nja kalja juoksee kurkusta",
+    },
+    {
+        "id": "ilta#0",
+        "name": "Ilta meren rannalla",
+        "melody": None,
+        "composer": "J. Sibelius",
+        "lyrics": "Kilta meri ilta\n\nmeri kuohuu, ja juon\nkaljaa rannalla",
+    },
+    {
+        "id": "ilta#1",
+        "name": "Toinen ilta",
+        "melody": None,
+        "composer": None,
+        "lyrics": "Ilta meri hiljaa\nja juomalaulu soi",
+    },
+    {
+        "id": "sitsit#0",
+        "name": "Sitsilaulu",
+        "melody": "Teemu",
+        "composer": None,
+        "lyrics": "Sitsit alkaa, kippis\nja juodaan taas",
+    },
+]
+
+QUERIES = [
+    "",
+    "ja",
+    "teemu",
+    "ja juo",
+    "ilta meri",
+    "meri kuohuu ja",
+    "kalja juo",
+    '"meri kuohuu"',
+    "sanat: ja juo",
+    "sävel: teemu",
+    "säv: sibelius",
+]
+
+
+def write_songs(directory, songs):
+    path = directory / "songs.json"
+    path.write_text(json.dumps(songs, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture(name="songs_file")
+def fixture_songs_file(tmp_path):
+    return write_songs(tmp_path, SONGS)
+
+
+def found(db, query):
+    return [
+        (hit.index, hit.score, hit.start, hit.end, hit.verse, hit.line)
+        for hit in db.search_hits(query, 50)
+    ]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_compressed_lyrics_find_the_same(songs_file, query):
+    plain = SongDatabase(songs_file)
+    compressed = SongDatabase(songs_file, compress_lyrics=True)
+    assert found(compressed, query) == found(plain, query)
+
+
+def test_search_does_not_decompress_lyrics(songs_file, monkeypatch):
+    db = SongDatabase(songs_file, compress_lyrics=True)
+    decompressed = []
+    get = db.lyrics.get
+    monkeypatch.setattr(
+        db.lyrics, "get", lambda idx: decompressed.append(idx) or get(idx)
+    )
+    for query in QUERIES:
+        for hit in db.search_hits(query, 50):
+            assert "lyrics" not in hit.song
+    assert not decompressed
+    assert db.song(0)["lyrics"] == SONGS[0]["lyrics"]
+
+
+ADDED = {
+    "id": "uusi#0",
+    "name": "Uusi ilta",
+    "melody": "Teemu",
+    "composer": None,
+    "lyrics": "Uusi meri kuohuu\nja kalja juoksee",
+}
+
+
+def found_by_key(db, query):
+    return [
+        (song_key(hit.song), hit.score, hit.start, hit.end, hit.verse, hit.line)
+        for hit in db.search_hits(query, 50)
+    ]
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+@pytest.mark.parametrize("compress_lyrics", [False, True])
+def test_applied_changes_match_a_full_rebuild(
+    tmp_path, songs_file, engine, compress_lyrics
+):
+    if engine == "numpy":
+        pytest.importorskip("scipy")
+    changed = dict(SONGS[1], lyrics="Kilta meri ilta\n\nmeri tyyntyy, ja juon")
+    # Changed songs keep their place and new ones go last, like in a rebuild
+    new_songs = [SONGS[0], changed, SONGS[3], ADDED]
+    changes = [changed, ADDED]
+    given = copy.deepcopy(changes)
+
+    db = SongDatabase(songs_file, engine=engine, compress_lyrics=compress_lyrics)
+    db.apply_changes(changes, [song_key(SONGS[2])])
+    assert changes == given
+    assert db.song_count() == len(new_songs)
+
+    (tmp_path / "rebuilt").mkdir()
+    rebuilt = SongDatabase(
+        write_songs(tmp_path / "rebuilt", new_songs),
+        engine=engine,
+        compress_lyrics=compress_lyrics,
+    )
+    queries = QUERIES + ["tyyntyy", "kuohuu", "uusi", "hiljaa"]
+    for query in queries:
+        assert found_by_key(db, query) == found_by_key(rebuilt, query), query
+    db.compact()
+    for query in queries:
+        assert found_by_key(db, query) == found_by_key(rebuilt, query), query
+
+
+def test_songs_must_be_loaded_before_use():
+    with pytest.raises(RuntimeError, match="load_songs"):
+        fiisubot.song_db.search("teemu")
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_cached_renders_do_not_load_the_song(tmp_path, monkeypatch, backend):
+    songs = [
+        dict(song, arranger=None, notes=None, content_hash=f"hash{i}")
+        for i, song in enumerate(SONGS)
+    ]
+    if backend == "sqlite":
+        write_sqlite_database(songs, str(tmp_path / "songs.sqlite3"))
+        db = SqliteSongDatabase(str(tmp_path / "songs.sqlite3"))
+    else:
+        db = SongDatabase(write_songs(tmp_path, songs), compress_lyrics=True)
+    monkeypatch.setattr(fiisubot, "song_db", db)
+    fiisubot.render_song_version.cache_clear()
+    rendered = fiisubot.render_song_at(1)
+
+    loaded = []
+    song = db.song
+    monkeypatch.setattr(db, "song", lambda idx: loaded.append(idx) or song(idx))
+    assert fiisubot.render_song_at(1) == rendered
+    assert db.key_of(1) == "ilta#0"
+    assert not loaded
+
+
+def test_lyrics_changed_while_decompressing_are_not_cached_stale(monkeypatch):
+    lyrics = CompressedLyrics(["vanhat sanat", "muut sanat"], cache_size=4)
+    decompressobj = zlib.decompressobj
+
+    def changing_decompressobj(**kwargs):
+        # The song changes while its old lyrics are being decompressed
+        monkeypatch.setattr(zlib, "decompressobj", decompressobj)
+        lyrics.put(0, "uudet sanat")
+        return decompressobj(**kwargs)
+
+    monkeypatch.setattr(zlib, "decompressobj", changing_decompressobj)
+    assert lyrics.get(0) == "vanhat sanat"
+    assert lyrics.get(0) == "uudet sanat"
+
+
+def test_similarities_of_other_songs_are_not_used(tmp_path):
+    (tmp_path / "similarity.json").write_text(
+        json.dumps(build_similarity_index(SONGS)), encoding="utf-8"
+    )
+    assert SongDatabase(write_songs(tmp_path, SONGS)).similarity is not None
+
+    # As many songs, but one replaced by another
+    replaced = SONGS[:3] + [dict(SONGS[0], id="uusi#0", name="Uusi laulu")]
+    assert SongDatabase(write_songs(tmp_path, replaced)).similarity is None